@@ -0,0 +1,407 @@
+#!/usr/bin/env python2
+
+"""
+Benchmarks for exportissues.py, run offline against data dumped by
+previous exports or a corpus of recorded responses.
+"""
+
+from __future__ import print_function
+
+
+import hashlib
+import json
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import timeit
+
+from collections import defaultdict
+
+import exportissues
+import httpfetch
+
+
+def setup_exportissues(project, verbose=-1, commits_map=None):
+    """
+    Initializes globals of exportissues the way its main() does.
+    Negative verbosity suppresses all the output.
+    """
+    exportissues.options = exportissues.Namespace(
+            verbose=verbose,
+            issues_start_from=1,
+            github_repo='{0}/{0}'.format(project))
+    exportissues.google_project_name = project
+    exportissues.ref_re = exportissues.re.compile(
+            exportissues.REF_RE_TMPL.format(project))
+
+    exportissues.commit_map = {}
+    if commits_map:
+        with open(commits_map, 'r') as f:
+            for line in f:
+                if line.strip():
+                    key, value = (s.strip() for s in line.split(None, 1))
+                    exportissues.commit_map[key] = value
+
+
+def best_time(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def report(name, nr_items, seconds):
+    per_item = seconds / nr_items if nr_items else 0
+    print("{:<24} {:>8} items {:>10.3f} s {:>10.2f} us/item"
+          .format(name, nr_items, seconds, per_item * 1e6))
+
+
+def bench_refs(args, options):
+    """
+    Rewrites references in every message of a messages dump.
+    """
+    if len(args) != 1:
+        return False
+
+    messages = exportissues.read_messages(args[0])
+    texts = [line for msg_id, body in messages.items()
+                  for line in body.split('\n\n')]
+
+    def run():
+        refs = set()
+        for text in texts:
+            exportissues.fixup_refs(text, add_ref=refs.add)
+
+    report('fixup_refs', len(texts), best_time(run, options.repeat))
+    return True
+
+
+def bench_parse(args, options):
+    """
+    Extracts records of the description and comments from saved issue pages.
+    """
+    if not args:
+        return False
+
+    pages = []
+    for filename in args:
+        with open(filename, 'rb') as f:
+            pages.append(f.read())
+
+    base_url = exportissues.GOOGLE_ISSUE_PAGE_URL.format(options.project, 1)
+    nr_comments = sum(len(exportissues.extract_gcode_issue_page(page, base_url).comments)
+                      for page in pages)
+
+    def run():
+        for page in pages:
+            exportissues.extract_gcode_issue_page(page, base_url)
+
+    seconds = best_time(run, options.repeat)
+    report('extract (pages)', len(pages), seconds)
+    report('extract (comments)', nr_comments, seconds)
+    return True
+
+
+class CorpusFetcher(object):
+    """
+    Stands for httpfetch.Fetcher serving responses recorded in a corpus
+    directory. Given a fetcher, responses missing in the corpus are fetched
+    with it and recorded. Gists are never created, POST requests get a fake
+    response made up from the data.
+    """
+
+    def __init__(self, path, fetcher=None):
+        super(CorpusFetcher, self).__init__()
+        self.path = path
+        self.fetcher = fetcher
+        self.lock = threading.Lock()
+
+        self.index_filename = os.path.join(path, 'index.json')
+        try:
+            self.index = exportissues.read_json(self.index_filename)
+        except IOError:
+            self.index = {}  # URL -> [filename, content type]
+
+    def get(self, url, headers=None, max_age=None):
+        with self.lock:
+            entry = self.index.get(url)
+        if entry:
+            filename, content_type = entry
+            with open(os.path.join(self.path, filename), 'rb') as f:
+                return httpfetch.Response(url, f.read(), content_type, from_cache=True)
+
+        if not self.fetcher:
+            raise httpfetch.NotCachedError("Not in the corpus: {}".format(url))
+
+        response = self.fetcher.get(url, headers, max_age)
+
+        filename = hashlib.sha1(url).hexdigest()
+        with open(os.path.join(self.path, filename), 'wb') as f:
+            f.write(response.body)
+        with self.lock:
+            self.index[url] = [filename, response.content_type]
+        return response
+
+    def post(self, url, data, headers=None):
+        gist_id = hashlib.sha1(data).hexdigest()[:20]
+        files = json.loads(data)['files']
+        body = json.dumps({
+            'html_url': 'https://gist.github.com/' + gist_id,
+            'files': dict((name, {'raw_url': 'https://gist.githubusercontent.com/'
+                                             'raw/{}/{}'.format(gist_id, name)})
+                          for name in files)})
+        return httpfetch.Response(url, body, 'application/json')
+
+    def close(self):
+        if self.fetcher:
+            self.fetcher.close()
+            exportissues.write_json(self.index, self.index_filename)
+
+
+class FetcherShim(object):
+    """
+    The httpfetch module as seen by exportissues, with Fetcher replaced.
+    """
+
+    def __init__(self, make_fetcher):
+        super(FetcherShim, self).__init__()
+        self.Fetcher = make_fetcher
+
+    def __getattr__(self, name):
+        return getattr(httpfetch, name)
+
+
+class StageTimer(object):
+    """
+    Collects durations of calls to functions of exportissues, which are
+    replaced with timed wrappers for the time of a run.
+    """
+
+    def __init__(self, names, generator_names=()):
+        super(StageTimer, self).__init__()
+        self.samples = defaultdict(list)
+        self.originals = {}
+        for name in names:
+            self.wrap(name, self.timed)
+        for name in generator_names:
+            self.wrap(name, self.timed_generator)
+
+    def wrap(self, name, wrapper):
+        func = self.originals[name] = getattr(exportissues, name)
+        setattr(exportissues, name, wrapper(func, self.samples[name]))
+
+    def restore(self):
+        for name, func in self.originals.items():
+            setattr(exportissues, name, func)
+
+    @staticmethod
+    def timed(func, samples):
+        def timed_func(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                samples.append(timeit.default_timer() - start)
+        return timed_func
+
+    @staticmethod
+    def timed_generator(func, samples):
+        """ Times getting each of the elements. """
+        def timed_func(*args, **kwargs):
+            it = func(*args, **kwargs)
+            while True:
+                start = timeit.default_timer()
+                try:
+                    el = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    samples.append(timeit.default_timer() - start)
+                yield el
+        return timed_func
+
+
+def percentile(sorted_samples, percent):
+    if not sorted_samples:
+        return 0
+    return sorted_samples[int(round(percent / 100.0 * (len(sorted_samples) - 1)))]
+
+def stage_stats(samples):
+    samples = sorted(samples)
+    return {'count': len(samples),
+            'total': sum(samples),
+            'p50':   percentile(samples, 50),
+            'p90':   percentile(samples, 90),
+            'p99':   percentile(samples, 99),
+            'max':   percentile(samples, 100)}
+
+# Inclusive: get_gcode_issue calls init_message, for example.
+STAGES = [
+    'get_gcode_issue_summaries',
+    'get_gcode_issue',
+    'init_message',
+    'format_message',
+    'dump_json',
+]
+
+def run_export(corpus, export_args, work_dir=None, record=False):
+    """
+    Runs exportissues.main() with the given arguments in a scratch
+    directory, fetching from the corpus. Returns the results dictionary.
+    """
+    corpus = os.path.abspath(corpus)
+    if not os.path.exists(corpus):
+        os.makedirs(corpus)
+
+    cwd = os.getcwd()
+    scratch = work_dir is None
+    if scratch:
+        work_dir = tempfile.mkdtemp(prefix='benchmark-')
+    elif not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    def make_fetcher(*args, **kwargs):
+        return CorpusFetcher(corpus, httpfetch.Fetcher(*args, **kwargs) if record else None)
+
+    timer = StageTimer(STAGES[1:], generator_names=STAGES[:1])
+    exportissues.httpfetch = FetcherShim(make_fetcher)
+    sys.argv = ['exportissues.py'] + export_args
+    os.chdir(work_dir)
+    start = timeit.default_timer()
+    try:
+        exportissues.main()
+    finally:
+        seconds = timeit.default_timer() - start
+        os.chdir(cwd)
+        exportissues.httpfetch = httpfetch
+        timer.restore()
+        if scratch:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    nr_issues = len(timer.samples['get_gcode_issue'])
+    return {
+        'args':                 export_args,
+        'issues':               nr_issues,
+        'seconds':              seconds,
+        'issues_per_sec':       nr_issues / seconds if seconds else 0,
+        'peak_rss_kb':          resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_rss_children_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'stages':               dict((name, stage_stats(timer.samples[name]))
+                                     for name in STAGES),
+    }
+
+def report_results(results):
+    print("{issues} issues in {seconds:.3f} s, {issues_per_sec:.2f} issues/s, "
+          "peak RSS {peak_rss_kb} KB (children {peak_rss_children_kb} KB)"
+          .format(**results))
+    print("{:<26} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}"
+          .format('stage', 'calls', 'total s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for name in STAGES:
+        stats = results['stages'][name]
+        print("{:<26} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}"
+              .format(name, stats['count'], stats['total'],
+                      *(stats[key] * 1e3 for key in ('p50', 'p90', 'p99', 'max'))))
+
+
+def bench_record(args, options):
+    """
+    Runs an export recording all fetched responses into the corpus.
+    Arguments after the corpus are passed to exportissues.py, use --offline
+    to record responses from its HTTP cache.
+    """
+    if not args:
+        return False
+
+    report_results(run_export(args[0], args[1:], options.work_dir, record=True))
+    return True
+
+def bench_pipeline(args, options):
+    """
+    Replays the corpus through the whole export, timing each stage.
+    Arguments after the corpus are passed to exportissues.py, relative
+    paths in them are resolved against the work directory.
+    """
+    if not args:
+        return False
+
+    results = run_export(args[0], args[1:] + ['--no-http-cache'], options.work_dir)
+    report_results(results)
+    if options.output:
+        exportissues.write_json(results, options.output)
+    return True
+
+def bench_compare(args, options):
+    """
+    Compares results saved by pipeline benchmarks.
+    """
+    if len(args) != 2:
+        return False
+
+    old, new = (exportissues.read_json(filename) for filename in args)
+
+    def ratio(old_value, new_value):
+        return float(new_value) / old_value if old_value else float('nan')
+
+    print("{:<34} {:>10} {:>10} {:>8}".format('', 'old', 'new', 'new/old'))
+    print("{:<34} {:>10.2f} {:>10.2f} {:>8.2f}"
+          .format('issues/s', old['issues_per_sec'], new['issues_per_sec'],
+                  ratio(old['issues_per_sec'], new['issues_per_sec'])))
+    print("{:<34} {:>10} {:>10} {:>8.2f}"
+          .format('peak RSS KB', old['peak_rss_kb'], new['peak_rss_kb'],
+                  ratio(old['peak_rss_kb'], new['peak_rss_kb'])))
+    for name in STAGES:
+        if name not in old['stages'] or name not in new['stages']:
+            continue  # saved by a version timing other stages
+        for key in 'p50', 'p99':
+            old_value = old['stages'][name][key] * 1e3
+            new_value = new['stages'][name][key] * 1e3
+            print("{:<34} {:>10.3f} {:>10.3f} {:>8.2f}"
+                  .format('{} {} ms'.format(name, key), old_value, new_value,
+                          ratio(old_value, new_value)))
+    return True
+
+
+BENCHMARKS = {
+    'compare':  (bench_compare,  '<old.json> <new.json>'),
+    'parse':    (bench_parse,    '<page.html>...'),
+    'pipeline': (bench_pipeline, '<corpus> [<exportissues options>...]'),
+    'record':   (bench_record,   '<corpus> [<exportissues options>...]'),
+    'refs':     (bench_refs,     '<messages.txt>'),
+}
+
+
+def main():
+    parser = optparse.OptionParser(
+            usage="usage: %prog [options] <benchmark> [<args>...]\n\n" +
+                  "\n".join("  %prog {} {}".format(name, usage)
+                            for name, (func, usage) in sorted(BENCHMARKS.items())),
+            description="Benchmark parts of the export pipeline.")
+
+    parser.add_option('-p', '--project', default='project',
+            help='Google Code project name used in the data')
+    parser.add_option('--commits-map',
+            help='Map file for revision references')
+    parser.add_option('-r', '--repeat', type=int, default=5,
+            help='Number of runs to take the best time of')
+    parser.add_option('-o', '--output',
+            help='Save results of the pipeline benchmark to a JSON file')
+    parser.add_option('--work-dir',
+            help='Directory to run exports in, a temporary one by default')
+
+    parser.disable_interspersed_args()
+    options, args = parser.parse_args()
+
+    if not args or args[0] not in BENCHMARKS:
+        parser.print_help()
+        sys.exit(1)
+
+    setup_exportissues(options.project, commits_map=options.commits_map)
+
+    func, usage = BENCHMARKS[args[0]]
+    if not func(args[1:], options):
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
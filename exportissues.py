@@ -3,25 +3,37 @@
 from __future__ import print_function
 
 
+import bisect
 import codecs
-import contextlib
 import csv
 import hashlib
 import io
 import json
+import lxml.html
+import multiprocessing
 import optparse
 import os
 import re
+import signal
 import sys
+import threading
+import time
 import urllib2
 
 from collections import Counter
 from collections import defaultdict
+from collections import deque
 from collections import OrderedDict
 from ConfigParser import RawConfigParser
+from contextlib import contextmanager
 from datetime import datetime
 from datetime import timedelta
-from pyquery import PyQuery as pq
+from lxml import etree
+from multiprocessing.pool import ThreadPool
+from urlparse import urljoin
+
+import httpfetch
+import instrument
 
 
 # The maximum number of records to retrieve from Google Code in a single request
@@ -51,10 +63,15 @@ GITHUB_ISSUES_URL = 'https://github.com/{0}/issues'
 GITHUB_SOURCE_PAGE_URL = GITHUB_SOURCE_URL + '/{1}/{2}'  # ref/path
 GITHUB_ISSUES_PAGE_URL = GITHUB_ISSUES_URL + '/{1}'      # number
 
+GITHUB_GISTS_URL = 'https://api.github.com/gists'
+
 
 milestones      = OrderedDict()
 missing_authors = defaultdict(Counter)
 
+stats    = instrument.Stats()
+progress = instrument.Progress()
+
 
 ###############################################################################
 
@@ -91,6 +108,31 @@ class ExtraNamespace(Namespace):
         self.extra = Namespace()
 
 
+class UniqueList(list):
+    """
+    List ignoring elements appended again, with membership tested in a set.
+    Serialized to JSON as a plain list.
+    """
+
+    def __init__(self, iterable=()):
+        super(UniqueList, self).__init__()
+        self.elements = set()
+        for el in iterable:
+            self.append(el)
+
+    def __contains__(self, el):
+        return el in self.elements
+
+    def append(self, el):
+        if el not in self.elements:
+            self.elements.add(el)
+            super(UniqueList, self).append(el)
+
+    def remove(self, el):
+        super(UniqueList, self).remove(el)
+        self.elements.discard(el)
+
+
 def uniq(iterable):
     """List unique elements, preserving order."""
     seen = set()
@@ -103,21 +145,96 @@ def uniq(iterable):
 def non_empty(iterable):
     return (el for el in iterable if el)
 
+# AsyncResult.get() without a timeout can't be interrupted with Ctrl-C
+WAIT_FOREVER = 0xFFFF
+
+def prefetch(func, iterable, workers=1, ahead=None):
+    """
+    Yields (el, func(el)) pairs for each element of the iterable, in order.
+
+    With more than one worker, func() is run by a pool of threads, computing
+    at most 'ahead' results (twice the number of workers by default) before
+    they are consumed.
+    """
+    if workers <= 1:
+        for el in iterable:
+            yield el, func(el)
+        return
+
+    if ahead is None:
+        ahead = 2 * workers
+
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for el in iterable:
+            pending.append((el, pool.apply_async(func, (el,))))
+            if len(pending) > ahead:
+                el, result = pending.popleft()
+                yield el, result.get(WAIT_FOREVER)
+        while pending:
+            el, result = pending.popleft()
+            yield el, result.get(WAIT_FOREVER)
+    finally:
+        pool.terminate()
+        pool.join()
 
 def read_json(filename):
     with open(filename, "r") as fp:
         return json.load(fp)
 
-def write_json(obj, filename):
-    def namespace_to_dict(obj):
-        if isinstance(obj, Namespace):
-            return obj.__dict__
-        raise TypeError("{} is not JSON serializable".format(obj))
+def namespace_to_dict(obj):
+    if isinstance(obj, Namespace):
+        return obj.__dict__
+    raise TypeError("{} is not JSON serializable".format(obj))
+
+def dump_json(obj, compact=False):
+    if compact:
+        return json.dumps(obj, separators=(',', ':'), default=namespace_to_dict) + '\n'
+    return json.dumps(obj, indent=4, separators=(',', ': '), sort_keys=True,
+                      default=namespace_to_dict) + '\n'
 
+def write_json(obj, filename, compact=False):
     with open(filename, "w") as fp:
-        json.dump(obj, fp, indent=4, separators=(',', ': '), sort_keys=True,
-                  default=namespace_to_dict)
-        fp.write('\n')
+        fp.write(dump_json(obj, compact))
+
+@contextmanager
+def atomic_open(filename):
+    """
+    Opens a temporary file renamed to the given filename once it is written
+    and synced to the disk, so that the file is never left partially written.
+    """
+    tmp_filename = filename + '.tmp'
+    try:
+        with open(tmp_filename, 'wb') as fp:
+            yield fp
+            fp.flush()
+            os.fsync(fp.fileno())
+    except BaseException:
+        exc_info = sys.exc_info()
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise exc_info[0], exc_info[1], exc_info[2]
+    os.rename(tmp_filename, filename)
+
+def sync_dir(dirname):
+    """ Makes renames of files in the directory durable. """
+    fd = os.open(dirname or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def remove_tmp_files(dirname):
+    """ Removes temporary files left in the directory by an interrupted run. """
+    for name in os.listdir(dirname):
+        if name.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(dirname, name))
+            except OSError:
+                pass
 
 def output(string='', level=0, fp=sys.stdout):
     if options.verbose >= level:
@@ -358,32 +475,50 @@ def format_message(m, comment_nr=0):
 
 def add_issue_to_github(issue):
     """ Migrates the given Google Code issue to Github. """
+    with stats.timer('attachments.wait'):
+        for m in [issue] + issue.extra.comments:
+            finish_attachments(m)
+
     output('Exporting issue {}'.format(issue.number), level=1)
 
-    format_message(issue)
-    write_json(issue, "out/issues/{}.json".format(issue.number))
+    with stats.timer('format'):
+        format_message(issue)
+        for i, comment in enumerate(issue.extra.comments):
+            format_message(comment, i+1)
+
+    comments = [comment for comment in issue.extra.comments if comment.body]
+    with stats.timer('write'):
+        if issue_shards:
+            issue_shards.write(issue.number, issue, comments)
+        else:
+            output_writer.write("out/issues/{}.json".format(issue.number),
+                                dump_json(issue, options.compact_json))
+            output_writer.write("out/issues/{}.comments.json".format(issue.number),
+                                dump_json(comments, options.compact_json))
 
-    for i, comment in enumerate(issue.extra.comments):
-        format_message(comment, i+1)
-    write_json([comment for comment in issue.extra.comments if comment.body],
-               "out/issues/{}.comments.json".format(issue.number))
+    stats.count('issues.exported')
+    stats.count('comments.exported', len(comments))
 
 
 ###############################################################################
 
-def split_into_paragraphs(pquery, title_selector='b'):
+def split_into_paragraphs(elements):
+    """
+    Splits contents of the given elements into (title, text) pairs,
+    where titles are in bold.
+    """
     paragraphs = []
 
     was_title = None
     title = ''
     accum_text = ''
 
-    for paragraph in pquery.contents():
+    for paragraph in (node for el in elements for node in CONTENTS_XPATH(el)):
         is_str = isinstance(paragraph, basestring)
         text = (paragraph if is_str else (paragraph.text or '').strip())
         if not text:
             continue
-        is_title = not is_str and pq(paragraph).is_(title_selector)
+        is_title = not is_str and paragraph.tag == 'b'
         if is_title == was_title:
             accum_text += text
             continue
@@ -393,7 +528,7 @@ def split_into_paragraphs(pquery, title_selector='b'):
                 title = accum_text
             else:
                 paragraphs.append((title, accum_text))
-        accum_text = text
+        accum_text = unicode(text)
         was_title = is_title
     else:
         if was_title is not None:
@@ -409,24 +544,66 @@ def join_paragraphs(paragraphs):
     return '\n\n'.join(title + '\n' + body for title, body in paragraphs).strip()
 
 
-def map_author(gc_uid, kind=None):
-    if not gc_uid:
-        return gc_uid, None
+class AuthorIndex(object):
+    """
+    Resolves Google Code user names into (email, gh_user) matches
+    from the authors map, memoizing the result for each user name.
+    """
+
+    def __init__(self, author_map):
+        super(AuthorIndex, self).__init__()
+        # Sorted by lowercase email to look up by prefix, with the original
+        # position used to report matches in the order of the authors map.
+        self.entries = sorted((email.lower(), pos, email, gh_user)
+                              for pos, (email, gh_user)
+                              in enumerate(author_map.items()))
+        self.keys = [entry[0] for entry in self.entries]
+        self.memo = {}
+
+    def _candidates(self, prefix):
+        prefix = prefix.lower()
+        for i in xrange(bisect.bisect_left(self.keys, prefix), len(self.keys)):
+            if not self.keys[i].startswith(prefix):
+                break
+            yield self.entries[i]
 
-    email_pat = gc_uid
-    if '@' not in email_pat:
-        email_pat += '@gmail.com'
-    email_pat = re.escape(email_pat).replace(r'\.\.\.\@', r'[\w.]+\@')
-    email_re = re.compile(email_pat, re.I)
+    def lookup(self, gc_uid):
+        try:
+            return self.memo[gc_uid]
+        except KeyError:
+            pass
+
+        email_pat = gc_uid
+        if '@' not in email_pat:
+            email_pat += '@gmail.com'
+
+        # Google Code masks emails like 'abc...@gmail.com'
+        prefix, masked, domain = email_pat.partition('...@')
+        if masked:
+            email_re = re.compile(re.escape(prefix) + r'[\w.]+\@' + re.escape(domain), re.I)
+            candidates = (entry for entry in self._candidates(prefix)
+                          if email_re.match(entry[2]))
+        else:
+            candidates = self._candidates(email_pat)
 
-    matches = []
-    for email, gh_user in author_map.items():
-        if email_re.match(email):
+        matches = []
+        for _, _, email, gh_user in sorted(candidates, key=lambda entry: entry[1]):
             if email.endswith('@gmail.com'):
                 email = email[:-len('@gmail.com')]
             if email.lower() == gc_uid.lower():
                 email = gc_uid  # when possible, preserve the original case
             matches.append((email, gh_user))
+
+        self.memo[gc_uid] = matches
+        return matches
+
+
+def map_author(gc_uid, kind=None):
+    if not gc_uid:
+        return gc_uid, None
+
+    with stats.timer('map_author'):
+        matches = author_index.lookup(gc_uid)
     if len(set(gh_user for email, gh_user in matches)) > 1:
         output('FIXME: multiple matches for {gc_uid}'.format(**locals()))
         for email, gh_user in matches:
@@ -471,7 +648,13 @@ REF_RE_TMPL = r'''(?x)
     (?(file)\#(?P<line>\d+))?
 '''
 
-def fixup_refs(s, add_ref=None):
+# Any text matched by REF_RE_TMPL contains one of these
+REF_HINT_RE = re.compile(r'[Ii]s[su]{2}e|[Rr]ev|[Cc]ommit|\br\d\d|code\.google\.com')
+
+def fixup_refs(s, add_ref=None, log=output):
+    if not REF_HINT_RE.search(s):
+        return s
+
     def fix_ref(match):
         ref = None
 
@@ -485,7 +668,7 @@ def fixup_refs(s, add_ref=None):
                 try:
                     ref = commit_map[value]
                 except KeyError:
-                    output("Warning: no mapping for commit '{}'".format(value))
+                    log("Warning: no mapping for commit '{}'".format(value))
 
             filename = match.group('file')
             if filename:
@@ -510,90 +693,367 @@ def fixup_refs(s, add_ref=None):
         if add_ref is not None:
             add_ref(ref)
 
-        output("Mapping text ref {:>24} -> {:<6}  :  {:<40}"
-               .format(match.group(), link or value, ref), level=3)
+        if options.verbose >= 3:
+            log("Mapping text ref {:>24} -> {:<6}  :  {:<40}"
+                .format(match.group(), link or value, ref), level=3)
         return ref
 
-    return re.sub(REF_RE_TMPL.format(google_project_name), fix_ref, s)
+    return ref_re.sub(fix_ref, s)
 
 
-def init_attachments(m, pquery):
-    m.extra.attachments = None
+class JournaledDict(object):
+    """
+    Dictionary kept in a JSON file along with an append-only journal of
+    entries set since the file was written. Each entry is synced to the disk
+    as soon as it is set, so that none are lost in case of a crash. The
+    journal is merged into the JSON file on load and when closed.
+    Safe to use from multiple threads.
+    """
 
-    if m.extra.link in attachments_cache:
-        attachments = attachments_cache[m.extra.link]
-        if attachments:
-            m.extra.attachments = Namespace(**attachments)
-            output('Gist attachments URL (from cache): {}'
-                   .format(m.extra.attachments.url), level=1)
-        return
+    def __init__(self, filename):
+        super(JournaledDict, self).__init__()
+        self.filename = filename
+        self.journal_filename = os.path.splitext(filename)[0] + '.journal'
+        self.lock = threading.Lock()
 
-    cache_attachments = None
-    files = OrderedDict()
-    for attachment_pq in pquery('.attachments > table').items():
-        for link in attachment_pq('a').items():
-            if link.text() == 'Download':
-                break
-        else:
-            continue
+        try:
+            self.entries = read_json(self.filename)
+        except IOError:
+            self.entries = {}
+
+        try:
+            with open(self.journal_filename, 'r') as fp:
+                for line in fp:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        break  # partially written last entry
+                    self.entries[key] = value
+        except IOError:
+            pass
+
+        self.compact()
+        self.journal = open(self.journal_filename, 'a')
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def items(self):
+        with self.lock:
+            return self.entries.items()
+
+    def __setitem__(self, key, value):
+        if isinstance(value, Namespace):
+            value = value.__dict__
+        line = json.dumps([key, value], sort_keys=True) + '\n'
+
+        with self.lock:
+            self.entries[key] = value
+            self.journal.write(line)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.compact()
+
+    def compact(self):
+        """ Rewrites the JSON file with all entries and empties the journal. """
+        with atomic_open(self.filename) as fp:
+            fp.write(dump_json(self.entries))
+
+        # the journal is only truncated once the file is safely replaced,
+        # replaying it again in case of a crash in between is harmless
+        with open(self.journal_filename, 'w'):
+            pass
 
-        attachment_name = attachment_pq('b').text()
-        attachment_url = link.attr('href')
+    def close(self):
+        with self.lock:
+            self.journal.close()
+            self.compact()
 
-        output("Downloading attachment '{}' "
-               .format(attachment_name), level=2)
+
+class AttachmentStore(object):
+    """
+    Content-addressed store of attachment files keyed by SHA-256 of their
+    content, including binary files not uploaded to Gists. Journaled indices
+    keep the files of each message, digests of already downloaded URLs and
+    the Gists created so far, so that identical attachments are only
+    uploaded once. Safe to use from multiple threads.
+    """
+
+    def __init__(self, path, reuse=True):
+        super(AttachmentStore, self).__init__()
+        self.path = path
+        self.lock = threading.Lock()
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)):
+                remove_tmp_files(os.path.join(path, name))
+
+        # message link -> [[name, digest]]
+        self.links = JournaledDict(os.path.join(path, 'links.json'))
+        # attachment URL -> digest
+        self.urls = JournaledDict(os.path.join(path, 'urls.json'))
+        # Gist URL -> {digest: raw URL}
+        self.gists = JournaledDict(os.path.join(path, 'gists.json'))
+
+        if not reuse:
+            self.urls.clear()
+            self.gists.clear()
+
+        self.upload_locks = {}              # digest set -> [Lock, number of users]
+        self.blob_gists = defaultdict(set)  # digest -> Gist URLs
+        for gist_url, raw_urls in self.gists.items():
+            for digest in raw_urls:
+                self.blob_gists[digest].add(gist_url)
+
+    def blob_filename(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def put(self, url, content):
+        """ Stores the content downloaded from the URL, returns its digest. """
+        digest = hashlib.sha256(content).hexdigest()
+        filename = self.blob_filename(digest)
+        if not os.path.exists(filename):
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:
+                pass  # exists
+            tmp_filename = '{}.{}.tmp'.format(filename, threading.current_thread().ident)
+            try:
+                with open(tmp_filename, 'wb') as fp:
+                    fp.write(content)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.rename(tmp_filename, filename)
+            except (IOError, OSError):
+                try:
+                    os.remove(tmp_filename)
+                except OSError:
+                    pass
+                raise
+
+        self.urls[url] = digest
+        return digest
+
+    def get(self, digest):
+        with open(self.blob_filename(digest), 'rb') as fp:
+            return fp.read()
+
+    def lookup_url(self, url):
+        """ Returns the digest of a stored file downloaded from the URL. """
+        digest = self.urls.get(url)
+        if digest and os.path.exists(self.blob_filename(digest)):
+            return digest
+
+    @contextmanager
+    def uploading(self, digests):
+        """
+        Holds a lock while looking for a Gist with the given files and
+        uploading one, so that concurrent threads don't upload the same
+        files twice. The lock is dropped once no thread is using it.
+        """
+        key = frozenset(digests)
+        with self.lock:
+            entry = self.upload_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
         try:
-            with contextlib.closing(urllib2.urlopen(attachment_url)) as sf:
-                content = sf.read()
-        except urllib2.URLError:
-            output("FIXME: Unable to get an attachment file '{}' from '{}'"
-                   .format(attachment_name, attachment_url))
-            cache_attachments = False
-            continue
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.upload_locks[key]
+
+    def find_gist(self, digests):
+        """ Returns (url, {digest: raw URL}) of a Gist having just the files. """
+        with self.lock:
+            gist_urls = [gist_url
+                         for gist_url in set.intersection(*[self.blob_gists.get(digest, set())
+                                                            for digest in digests])
+                         if len(self.gists[gist_url]) == len(digests)]
+            if gist_urls:
+                gist_url = min(gist_urls)
+                return gist_url, self.gists[gist_url]
+
+    def find_raw_urls(self, digests):
+        """ Returns {digest: raw URL} of the files uploaded to any Gist. """
+        with self.lock:
+            return dict((digest, self.gists[min(self.blob_gists[digest])][digest])
+                        for digest in digests if self.blob_gists.get(digest))
+
+    def add_gist(self, gist_url, raw_urls):
+        with self.lock:
+            self.gists[gist_url] = raw_urls
+            for digest in raw_urls:
+                self.blob_gists[digest].add(gist_url)
+
+    def set_files(self, link, files):
+        self.links[link] = files
+
+    def close(self):
+        for index in self.links, self.urls, self.gists:
+            index.close()
+
+
+def upload_attachments(link, issue_number, attachment_links):
+    """
+    Downloads the attachments into the store and uploads them to a Gist,
+    unless there is one with the same files already. Files uploaded to
+    other Gists before are linked to there. Run in a worker
+    thread, log messages are collected to be output in order later.
+
+    Returns (attachments, log) tuple.
+    """
+    log = []
+    def output_later(string='', level=0):
+        log.append((string, level))
 
+    attachments = None
+    cache_attachments = None
+    stored_files = []
+    files = OrderedDict()  # name -> (digest, text)
+    for attachment_name, attachment_url in attachment_links:
+        digest = attachment_store.lookup_url(attachment_url)
+        if digest:
+            content = attachment_store.get(digest)
+        else:
+            output_later("Downloading attachment '{}' "
+                         .format(attachment_name), level=2)
+            try:
+                with stats.timer('attachments.download'):
+                    content = http.get(attachment_url).body
+            except urllib2.URLError:
+                output_later("FIXME: Unable to get an attachment file '{}' from '{}'"
+                             .format(attachment_name, attachment_url))
+                cache_attachments = False
+                continue
+            digest = attachment_store.put(attachment_url, content)
+            stats.count('attachments.downloaded')
+            stats.count('attachments.bytes', len(content))
+
+        stored_files.append([attachment_name, digest])
         try:
-            files[attachment_name] = {'content': content.decode('utf-8')}
+            files[attachment_name] = (digest, content.decode('utf-8'))
         except UnicodeDecodeError:
-            output("Skipping binary file", level=2)
+            output_later("Skipping binary file", level=2)
 
         if cache_attachments is None:
             # only set if no files failed to download previously
             cache_attachments = True
 
+    if cache_attachments:
+        attachment_store.set_files(link, stored_files)
+
     if files:
         if not cache_attachments:
-            output("Warning: some files have failed to download, "
-                   "Gist will be incomplete")
-        data = {'description': (('Issue attachments for {0}#{1}: ' +
-                                 GITHUB_ISSUES_PAGE_URL)
-                                .format(options.github_repo, m.extra.issue_number)),
-                'files': files, 'public': False}
+            output_later("Warning: some files have failed to download, "
+                         "Gist will be incomplete")
+
+        digests = set(digest for digest, text in files.values())
+        with attachment_store.uploading(digests):
+            gist = attachment_store.find_gist(digests)
+            if gist:
+                gist_url, raw_urls = gist
+                attachments = Namespace(
+                    url=gist_url,
+                    files=OrderedDict((name, raw_urls[digest])
+                                      for name, (digest, text) in files.items()))
+                stats.count('gists.reused')
+                output_later('Gist attachments URL (reused): {}'
+                             .format(attachments.url), level=1)
+            else:
+                raw_urls = attachment_store.find_raw_urls(digests)
+                data = {'description': (('Issue attachments for {0}#{1}: ' +
+                                         GITHUB_ISSUES_PAGE_URL)
+                                        .format(options.github_repo, issue_number)),
+                        'files': OrderedDict((name, {'content': text})
+                                             for name, (digest, text) in files.items()),
+                        'public': False}
 
-        request = urllib2.Request('https://api.github.com/gists', json.dumps(data),
-                                  {'Content-Type': 'application/json'})
+                try:
+                    with gist_uploads, stats.timer('attachments.gist'):
+                        response = json.loads(http.post(GITHUB_GISTS_URL, json.dumps(data),
+                                                        {'Content-Type': 'application/json'}).body,
+                                              object_pairs_hook=OrderedDict)
+                except urllib2.URLError:
+                    output_later("FIXME: Unable to post attachments to Gist")
+                    cache_attachments = False
+                else:
+                    attachment_store.add_gist(response['html_url'],
+                                              dict((files[name][0], obj['raw_url'])
+                                                   for name, obj in response['files'].items()
+                                                   if name in files))
+                    attachments = Namespace(
+                        url=response['html_url'],
+                        files=OrderedDict((name, raw_urls.get(files[name][0], obj['raw_url'])
+                                                 if name in files else obj['raw_url'])
+                                          for name, obj in response['files'].items()))
+                    stats.count('gists.created')
+                    output_later('Gist attachments URL: {}'
+                                 .format(attachments.url), level=1)
 
-        try:
-            with contextlib.closing(urllib2.urlopen(request)) as sf:
-                response = json.load(sf, object_pairs_hook=OrderedDict)
-        except urllib2.URLError:
-            output("FIXME: Unable to post attachments to Gist"
-                   .format(attachment_name, attachment_url))
-        else:
-            m.extra.attachments = Namespace(
-                url=response['html_url'],
-                files=OrderedDict((name, obj['raw_url'])
-                                  for name, obj in response['files'].items()))
-            output('Gist attachments URL: {}'
+    if cache_attachments:
+        # saved right away, so that a crash doesn't cause duplicate Gists
+        attachments_cache[link] = attachments
+
+    return attachments, log
+
+
+def init_attachments(m, attachment_links):
+    """
+    Starts uploading the attachments of a message in background,
+    use finish_attachments() to get the result.
+    """
+    m.extra.attachments = None
+    m.extra.attachments_job = None
+
+    if m.extra.link in attachments_cache:
+        attachments = attachments_cache[m.extra.link]
+        if attachments:
+            m.extra.attachments = Namespace(**attachments)
+            output('Gist attachments URL (from cache): {}'
                    .format(m.extra.attachments.url), level=1)
+        return
 
-    if cache_attachments:
-        attachments_cache[m.extra.link] = m.extra.attachments
+    if attachment_links:
+        m.extra.attachments_job = attachments_pool.apply_async(
+                upload_attachments, (m.extra.link, m.extra.issue_number, attachment_links))
 
 
-def init_message(m, pquery):
-    refs = set()
-    paragraphs = [tuple(fixup_refs(text, add_ref=refs.add) for text in pair)
-                  for pair in split_into_paragraphs(pquery('pre'))]
+def attachments_ready(issue):
+    return all(m.extra.attachments_job.ready()
+               for m in [issue] + issue.extra.comments
+               if m.extra.attachments_job)
+
+
+def finish_attachments(m):
+    """ Waits for the attachments of a message to be uploaded. """
+    if not m.extra.attachments_job:
+        return
+
+    attachments, log = m.extra.attachments_job.get(WAIT_FOREVER)
+    m.extra.attachments_job = None
+
+    for string, level in log:
+        output(string, level=level)
+
+    m.extra.attachments = attachments
+
+
+def init_message(m, record):
+    paragraphs = list(record.paragraphs)
 
     # Strip the placeholder text, if any
     if len(paragraphs) == 1 and hasattr(m.extra, 'updates'):
@@ -618,27 +1078,43 @@ def init_message(m, pquery):
         paragraphs[0][1] == '(No comment was entered for this change.)'):
         del paragraphs[0]
 
-    m.extra.refs = refs
+    m.extra.refs = record.refs
     m.extra.paragraphs = paragraphs
     m.body = join_paragraphs(paragraphs)
 
-    init_attachments(m, pquery)
+    init_attachments(m, record.attachments)
 
 
+def resolve_label(label):
+    """
+    Returns the label mapped through labels.ini, and whether it has the
+    milestone prefix. Memoized, as the same labels repeat on every issue.
+    """
+    try:
+        return label_resolutions[label]
+    except KeyError:
+        pass
+
+    mapped = label_map.get(label, label)
+    resolution = label_resolutions[label] = (
+        mapped, mapped.partition('-')[0] == options.milestone_label_prefix)
+    return resolution
+
 def get_milestone_or_add_label(label, labels_to_add):
-    label = label_map.get(label, label)
+    label, is_milestone = resolve_label(label)
     if not label:
         return
 
-    milestone = get_milestone(label)
-    if milestone:
-        return milestone
+    if is_milestone:
+        milestone = get_milestone(label)
+        if milestone:
+            return milestone
 
     if label not in labels_to_add:
         labels_to_add.append(label)
 
 
-def get_gcode_updates(updates_pq):
+def get_gcode_updates(update_paragraphs, milestone_refs):
     updates = Namespace(
         orig_owner    = None,
         assignee      = None,
@@ -647,16 +1123,16 @@ def get_gcode_updates(updates_pq):
         mergedinto    = None,
         new_milestone = None,
         old_milestone = None,
-        new_blockedon = [],
-        old_blockedon = [],
-        new_blocking  = [],
-        old_blocking  = [],
-        new_labels    = [],
-        old_labels    = [],
+        new_blockedon = UniqueList(),
+        old_blockedon = UniqueList(),
+        new_blocking  = UniqueList(),
+        old_blocking  = UniqueList(),
+        new_labels    = UniqueList(),
+        old_labels    = UniqueList(),
         merged_issue  = None,
         close_commit  = None)
 
-    for key, value in split_into_paragraphs(updates_pq):
+    for key, value in update_paragraphs:
         key = key.partition(':')[0]
 
         if key in ('Blockedon', 'Blocking', 'Labels'):
@@ -678,6 +1154,7 @@ def get_gcode_updates(updates_pq):
                 elif key == 'Labels':
                     milestone = get_milestone_or_add_label(word, lst)
                     if milestone:
+                        milestone_refs.append(milestone.title)
                         if is_removed:
                             updates.old_milestone = milestone.title
                         else:
@@ -704,17 +1181,18 @@ def get_gcode_updates(updates_pq):
     return updates
 
 
-def get_gcode_comment(issue, comment_pq):
+def get_gcode_comment(issue, record):
     comment = ExtraNamespace()
 
-    comment.created_at = parse_gcode_date(comment_pq('.date').attr('title'))
+    comment.created_at = parse_gcode_date(record.date)
     comment.updated_at = options.export_date or comment.created_at
 
     comment.extra.issue_number = issue.number
-    comment.extra.link = issue.extra.link + '#' + comment_pq('a').attr('name')
-    comment.extra.updates = get_gcode_updates(comment_pq('.updates .box-inner'))
+    comment.extra.link = issue.extra.link + '#' + record.anchor
+    comment.extra.updates = get_gcode_updates(record.updates,
+                                              issue.extra.milestone_refs)
 
-    comment.extra.orig_user, comment.user = map_author(comment_pq('.userlink').text(), 'comment')
+    comment.extra.orig_user, comment.user = map_author(record.user, 'comment')
 
     for state, labels in ('open', open_labels), ('closed', closed_labels):
         if issue.extra.last_state != state and comment.extra.updates.status in labels:
@@ -727,7 +1205,7 @@ def get_gcode_comment(issue, comment_pq):
     if comment.extra.updates.orig_owner is not None:
         issue.extra.initially_assigned = False
 
-    init_message(comment, comment_pq)
+    init_message(comment, record)
 
     paragraphs = comment.extra.paragraphs
     if len(paragraphs) > 1 or paragraphs and paragraphs[0][0]:
@@ -737,10 +1215,95 @@ def get_gcode_comment(issue, comment_pq):
     return comment
 
 
-def get_gcode_issue(summary):
-    output('Importing issue {}'.format(int(summary['ID'])), level=1)
+def xpath_has_class(name):
+    """ XPath condition matching the '.name' CSS selector. """
+    return ("@class and contains(concat(' ', normalize-space(@class), ' '), ' {} ')"
+            .format(name))
+
+CONTENTS_XPATH    = etree.XPath('child::text()|child::*')
+DESCRIPTION_XPATH = etree.XPath('descendant-or-self::*[{}]/descendant::*[{}]'
+                                .format(xpath_has_class('issuedescription'),
+                                        xpath_has_class('issuedescription')))
+COMMENTS_XPATH    = etree.XPath('descendant-or-self::*[{}]'
+                                .format(xpath_has_class('issuecomment')))
+DATE_XPATH        = etree.XPath('descendant-or-self::*[{}]'
+                                .format(xpath_has_class('date')))
+USERLINK_XPATH    = etree.XPath('descendant-or-self::*[{}]'
+                                .format(xpath_has_class('userlink')))
+ANCHOR_XPATH      = etree.XPath('descendant-or-self::a')
+BOLD_XPATH        = etree.XPath('descendant-or-self::b')
+PRE_XPATH         = etree.XPath('descendant-or-self::pre')
+UPDATES_XPATH     = etree.XPath('descendant-or-self::*[{}]/descendant::*[{}]'
+                                .format(xpath_has_class('updates'),
+                                        xpath_has_class('box-inner')))
+ATTACHMENTS_XPATH = etree.XPath('descendant-or-self::*[{}]/table'
+                                .format(xpath_has_class('attachments')))
+
+def element_text(elements):
+    """ Text of the elements with whitespace squashed, like PyQuery.text(). """
+    if not elements:
+        return None
+    return ' '.join(t.strip() for el in elements
+                              for t in el.itertext() if t.strip())
+
+def extract_gcode_message(elements, base_url):
+    """
+    Extracts a plain record of a description or a comment given its
+    elements, the same regardless of the global state.
+    """
+    def select(xpath):
+        return [x for el in elements for x in xpath(el)]
+
+    dates = select(DATE_XPATH)
+    anchors = select(ANCHOR_XPATH)
+
+    attachments = []
+    for table in select(ATTACHMENTS_XPATH):
+        for link in ANCHOR_XPATH(table):
+            if element_text([link]) == 'Download':
+                break
+        else:
+            continue
+
+        attachments.append((element_text(BOLD_XPATH(table)),
+                            urljoin(base_url, link.get('href'))))
+
+    return Namespace(
+        date        = dates[0].get('title') if dates else None,
+        anchor      = anchors[0].get('name') if anchors else None,
+        user        = element_text(select(USERLINK_XPATH)),
+        paragraphs  = split_into_paragraphs(select(PRE_XPATH)),
+        updates     = split_into_paragraphs(select(UPDATES_XPATH)),
+        attachments = attachments)
+
+def extract_gcode_issue_page(page, base_url):
+    """
+    Parses the issue details page into plain records of the description
+    and each comment, with precompiled XPath queries.
+    """
+    doc = lxml.html.fromstring(page)
+
+    comments = []
+    for comment_el in COMMENTS_XPATH(doc):
+        if not DATE_XPATH(comment_el):
+            continue # Sign in prompt line uses same class
+        if 'delcom' in comment_el.get('class', '').split():
+            continue # Skip deleted comments
+        comments.append(extract_gcode_message([comment_el], base_url))
+
+    return Namespace(
+        description = extract_gcode_message(DESCRIPTION_XPATH(doc), base_url),
+        comments    = comments)
 
-    # Populate properties available from the summary CSV
+
+def get_gcode_issue_page(summary, max_age=None):
+    """ Downloads the issue details page, safe to be called from any thread. """
+    url = GOOGLE_ISSUE_PAGE_URL.format(google_project_name, summary['ID'])
+    with stats.timer('fetch.page'):
+        return http.get(url, max_age=max_age).body
+
+def init_gcode_issue(summary):
+    """ Populates properties available from the summary CSV. """
     issue = ExtraNamespace(
         number     = int(summary['ID']) + (options.issues_start_from - 1),
         title      = summary['Summary'].strip(),
@@ -758,6 +1321,7 @@ def get_gcode_issue(summary):
 
     issue.extra.issue_number = issue.number
     issue.extra.last_state = 'open'  # initially, used to track updates
+    issue.extra.milestone_refs = []  # referenced by updates in comments
 
     orig_user = summary['Reporter']
     issue.extra.orig_user, issue.user = map_author(orig_user, 'reporter')
@@ -777,7 +1341,7 @@ def get_gcode_issue(summary):
 
     # Build a list of labels to apply to the new issue, including an 'imported' tag that
     # we can use to identify this issue as one that's passed through migration.
-    issue.labels = []
+    issue.labels = UniqueList()
     if options.imported_label:
         issue.labels.append(options.imported_label)
 
@@ -790,66 +1354,611 @@ def get_gcode_issue(summary):
                 milestone.state = 'open'
             issue.milestone = milestone.number
 
-    # Scrape the issue details page for the issue body and comments
-    doc = pq(issue.extra.link)
-    doc.make_links_absolute()
+    return issue
+
+def parse_gcode_issue_page(page, link):
+    """
+    Extracts records from the issue details page and rewrites references
+    in their text. Doesn't depend on the state changed during the export,
+    so it is safe to be called from a worker thread or process.
+    Log messages are collected to be output in order later.
+    """
+    log = []
+    def output_later(string='', level=0):
+        log.append((string, level))
+
+    start = time.time()
+    page_record = extract_gcode_issue_page(page, link)
+    for record in [page_record.description] + page_record.comments:
+        refs = set()
+        record.paragraphs = [tuple(fixup_refs(text, add_ref=refs.add, log=output_later)
+                                   for text in pair)
+                             for pair in record.paragraphs]
+        record.refs = refs
+
+    page_record.log = log
+    page_record.seconds = time.time() - start  # accounted by the caller
+    return page_record
+
+def init_parse_worker():
+    # Ctrl-C is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def get_gcode_issue(summary, page_record):
+    """
+    Builds the issue from the parsed page, resolving authors, labels and
+    milestones. Must be called in order of issues.
+    """
+    output('Importing issue {}'.format(int(summary['ID'])), level=1)
 
-    issue_pq = doc('.issuedescription .issuedescription')
+    issue = init_gcode_issue(summary)
 
-    init_message(issue, issue_pq)
+    for string, level in page_record.log:
+        output(string, level=level)
+    stats.add_time('parse', page_record.seconds)
 
-    issue.extra.comments = []
-    for comment_pq in map(pq, doc('.issuecomment')):
-        if not comment_pq('.date'):
-            continue # Sign in prompt line uses same class
-        if comment_pq.hasClass('delcom'):
-            continue # Skip deleted comments
+    with stats.timer('build'):
+        init_message(issue, page_record.description)
 
-        comment = get_gcode_comment(issue, comment_pq)
-        issue.extra.comments.append(comment)
+        issue.extra.comments = []
+        for record in page_record.comments:
+            comment = get_gcode_comment(issue, record)
+            issue.extra.comments.append(comment)
 
     return issue
 
-def get_gcode_issue_summaries():
-    issues = []
+def get_gcode_issue_summaries(set_total=lambda total: None):
+    """
+    Yields rows of the issues CSV, fetching the next page only when
+    the rows of the previous one have been consumed. The total number
+    of issues is passed to set_total() as soon as it is known.
+    """
+    nr_issues = 0
     while True:
         url = GOOGLE_ISSUES_CSV_URL.format(google_project_name,
-                                           GOOGLE_MAX_RESULTS, len(issues))
-        issues.extend(csv.DictReader(urllib2.urlopen(url), dialect=csv.excel))
+                                           GOOGLE_MAX_RESULTS, nr_issues)
+        with stats.timer('fetch.summaries'):
+            # Incremental exports tell changed issues from the summaries,
+            # which must not come from the cache then
+            body = http.get(url, max_age=0 if options.incremental else None).body
+        truncated = False
+        for row in csv.DictReader(io.BytesIO(body), dialect=csv.excel):
+            if 'truncated' in row['ID']:
+                truncated = True
+                # e.g. 'This file is truncated to 100 out of 1234 total results.'
+                match = re.search(r'out of (\d+)', row['ID'])
+                if match:
+                    set_total(int(match.group(1)))
+                break
+            nr_issues += 1
+            yield row
 
-        if issues and 'truncated' in issues[-1]['ID']:
-            issues.pop()
-        else:
+        if not truncated:
             break
 
-    output('Fetched summaries for {} issues'.format(len(issues)))
-    return issues
+    set_total(nr_issues)
+    output('Fetched summaries for {} issues'.format(nr_issues))
+
+def select_gcode_issue_summaries(summaries):
+    """
+    Filters summaries by --start-at, --end-at and --skip-closed options.
+
+    Stops consuming summaries (and thus fetching more CSV pages) after
+    passing the --end-at issue, relying on the CSV being sorted by ID.
+    """
+    for summary in summaries:
+        issue_id = int(summary['ID'])
+        if options.end_at is not None and issue_id > options.end_at:
+            break
+        if options.start_at is not None and issue_id < options.start_at:
+            continue
+        if options.skip_closed and summary['Closed']:
+            continue
+        yield summary
+
+
+class ExportManifest(object):
+    """
+    Tracks exported issues to skip the unchanged ones on subsequent runs.
+
+    For each issue it records digests of the CSV summary row and of the
+    output files, and what the issue page has contributed to the global
+    state: milestones referenced from comments and missing authors. That is
+    replayed for skipped issues, so that milestones are numbered and missing
+    authors are counted the same way as if all issues were exported again.
+
+    Any change of the configuration invalidates the whole manifest.
+    """
+
+    def __init__(self, filename, config_digest):
+        super(ExportManifest, self).__init__()
+        self.filename = filename
+        self.config_digest = config_digest
+
+        try:
+            manifest = read_json(filename)
+        except (IOError, ValueError):
+            manifest = {}
+
+        if manifest and manifest.get('config') != config_digest:
+            output("Configuration has changed, exporting all issues")
+            manifest = {}
+
+        self.old_entries = manifest.get('issues', {})
+        self.entries = dict(self.old_entries)
+
+    @staticmethod
+    def row_digest(summary):
+        return hashlib.sha1(json.dumps(sorted(summary.items()))).hexdigest()
+
+    @staticmethod
+    def output_digest(number):
+        if issue_shards:
+            line = issue_shards.read(number)
+            return hashlib.sha1(line).hexdigest() if line else None
+
+        digest = hashlib.sha1()
+        try:
+            for filename in ("out/issues/{}.json".format(number),
+                             "out/issues/{}.comments.json".format(number)):
+                digest.update(output_writer.read(filename))
+        except IOError:
+            return
+        return digest.hexdigest()
+
+    def unchanged_entry(self, summary):
+        """
+        Returns the entry of an issue unchanged since the last export, if any.
+        """
+        entry = self.old_entries.get(summary['ID'])
+        if (entry and entry['row'] == self.row_digest(summary) and
+            entry['output'] == self.output_digest(int(summary['ID']) +
+                                                  (options.issues_start_from - 1))):
+            return entry
+
+    def record(self, summary, issue):
+        missing = []
+        for comment in issue.extra.comments:
+            updates = comment.extra.updates
+            if updates.orig_owner and not updates.assignee:
+                missing.append(('owner', updates.orig_owner))
+            if comment.extra.orig_user and not comment.user:
+                missing.append(('comment', comment.extra.orig_user))
+
+        self.entries[summary['ID']] = {
+            'row':        self.row_digest(summary),
+            'output':     self.output_digest(issue.number),
+            'milestones': issue.extra.milestone_refs,
+            'missing':    missing,
+        }
+
+    def replay(self, summary, entry):
+        init_gcode_issue(summary)
+
+        for title in entry['milestones']:
+            get_milestone(options.milestone_label_prefix + '-' + title)
+        for kind, gc_uid in entry['missing']:
+            missing_authors[kind][gc_uid] += 1
+
+    def save(self):
+        write_json({'config': self.config_digest, 'issues': self.entries},
+                   self.filename)
+
+
+class OutputWriter(object):
+    """
+    Writes output files in a background thread, so that the export doesn't
+    wait for the disk. Each file is written with atomic_open(), so that it
+    is either complete or absent (or has the contents of the previous
+    export) if the run is interrupted. Directories are synced in groups,
+    once there are no more files queued or after every 'sync_every' files.
+
+    write() blocks while 'max_pending' files are queued. An error in the
+    writer thread is raised from the next call to write() or flush().
+    """
+
+    def __init__(self, max_pending=100, sync_every=100):
+        super(OutputWriter, self).__init__()
+        self.max_pending = max_pending
+        self.sync_every = sync_every
+
+        self.cond = threading.Condition()
+        self.queue = deque()  # (filename, data), the first one being written
+        self.pending = {}     # filename -> data of the last queued write
+        self.error = None
+        self.closing = False
+
+        self.thread = threading.Thread(target=self._run, name='output-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _check_error(self):
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def write(self, filename, data):
+        with self.cond:
+            while len(self.queue) >= self.max_pending and not self.error:
+                self.cond.wait(WAIT_FOREVER)
+            self._check_error()
+            self.queue.append((filename, data))
+            self.pending[filename] = data
+            self.cond.notify_all()
+
+    def read(self, filename, offset=0, length=None):
+        """
+        Returns contents of the file, or 'length' bytes of them starting at
+        'offset', including a write still queued.
+        """
+        with self.cond:
+            data = self.pending.get(filename)
+        if data is not None:
+            return data[offset:offset+length if length is not None else None]
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            return f.read(length if length is not None else -1)
+
+    def flush(self):
+        """ Waits until all queued files are written and synced. """
+        with self.cond:
+            while self.queue and not self.error:
+                self.cond.wait(WAIT_FOREVER)
+            self._check_error()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self.cond:
+                self.closing = True
+                self.cond.notify_all()
+            self.thread.join()
+
+    def _run(self):
+        unsynced_dirs = set()
+        nr_unsynced = 0
+        while True:
+            with self.cond:
+                while not self.queue and not self.closing:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                filename, data = self.queue[0]
+
+            try:
+                with stats.timer('write.disk'), atomic_open(filename) as fp:
+                    fp.write(data)
+                unsynced_dirs.add(os.path.dirname(filename))
+                nr_unsynced += 1
+
+                # The queue only grows meanwhile, so the last file written
+                # before flush() returns gets the directories synced.
+                if len(self.queue) == 1 or nr_unsynced >= self.sync_every:
+                    for dirname in unsynced_dirs:
+                        sync_dir(dirname)
+                    unsynced_dirs.clear()
+                    nr_unsynced = 0
+
+            except Exception:
+                with self.cond:
+                    self.error = sys.exc_info()
+                    self.queue.clear()
+                    self.pending.clear()
+                    self.cond.notify_all()
+                return
+
+            with self.cond:
+                self.queue.popleft()
+                if self.pending.get(filename) is data:
+                    del self.pending[filename]
+                self.cond.notify_all()
+
+
+class IssueShards(object):
+    """
+    Writes issues as lines of NDJSON shard files instead of a pair of
+    files per issue. Each shard holds a range of 'size' issue numbers,
+    e.g. '1-1000.ndjson', one {"issue": ..., "comments": [...]} object
+    per line, ordered by number. The index file maps issue numbers to
+    [shard, offset, length] of their lines.
+
+    The lines of the shard being written are kept in memory, along with
+    the ones left from the previous export, and the whole shard is
+    rewritten through the OutputWriter on flush() or when moving to the
+    next one. Lines may be read by other threads meanwhile.
+    """
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, path, size, writer):
+        super(IssueShards, self).__init__()
+        self.path = path
+        self.size = size
+        self.writer = writer
+
+        try:
+            self.index = read_json(os.path.join(path, self.INDEX_FILE))
+        except (IOError, ValueError):
+            self.index = {}
+
+        self.lock = threading.RLock()
+        self.shard = None  # name of the shard being written
+        self.lines = {}    # number -> line of the shard
+        self.dirty = False
+
+    def shard_name(self, number):
+        first = (number - 1) // self.size * self.size + 1
+        return '{}-{}.ndjson'.format(first, first + self.size - 1)
+
+    def _read_shard(self, shard):
+        try:
+            return self.writer.read(os.path.join(self.path, shard))
+        except IOError:
+            return ''
+
+    def read(self, number):
+        """ Returns the line of the issue, or None if there is none. """
+        with self.lock:
+            if self.shard_name(number) == self.shard:
+                return self.lines.get(number)
+
+            entry = self.index.get(str(number))
+            if not entry:
+                return
+            shard, offset, length = entry
+            try:
+                line = self.writer.read(os.path.join(self.path, shard), offset, length)
+            except IOError:
+                return
+            if len(line) == length:
+                return line
+
+    def _switch(self, shard):
+        self.flush()
+
+        data = self._read_shard(shard)
+        first = int(shard.partition('-')[0])
+        lines = {}
+        for number in xrange(first, first + self.size):
+            entry = self.index.get(str(number))
+            if entry and entry[0] == shard:
+                offset, length = entry[1:]
+                lines[number] = data[offset:offset+length]
+        self.shard = shard
+        self.lines = lines
+
+    def write(self, number, issue, comments):
+        line = json.dumps({'issue': issue, 'comments': comments},
+                          separators=(',', ':'), default=namespace_to_dict) + '\n'
+
+        with self.lock:
+            shard = self.shard_name(number)
+            if shard != self.shard:
+                self._switch(shard)
+
+            self.lines[number] = line
+            self.dirty = True
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            lines = []
+            offset = 0
+            for number, line in sorted(self.lines.items()):
+                lines.append(line)
+                self.index[str(number)] = [self.shard, offset, len(line)]
+                offset += len(line)
+            self.writer.write(os.path.join(self.path, self.shard), ''.join(lines))
+
+            self.writer.write(os.path.join(self.path, self.INDEX_FILE),
+                              dump_json(OrderedDict(sorted(self.index.items(),
+                                                           key=lambda item: int(item[0]))),
+                                        compact=True))
+
+            self.dirty = False
+
+
+class ExportCheckpoint(object):
+    """
+    Periodically saves the last exported issue along with the global state
+    accumulated so far: milestones, missing authors and messages. An export
+    resumed from the checkpoint produces the same output as the one that
+    has not been interrupted, so it also keeps the export date, which
+    defaults to the time the export has started.
+    """
+
+    def __init__(self, filename, config_digest, every):
+        super(ExportCheckpoint, self).__init__()
+        self.filename = filename
+        self.config_digest = config_digest
+        self.every = every
+        self.last_id = None
+        self.export_date = None
+        self.nr_unsaved = 0
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def load(self):
+        """ Restores the global state, returns False on options mismatch. """
+        checkpoint = read_json(self.filename)
+        if checkpoint['config'] != self.config_digest:
+            return False
+
+        self.last_id = checkpoint['last_id']
+        self.export_date = checkpoint['export_date']
+
+        milestones.clear()
+        for m in checkpoint['milestones']:
+            milestones[m['title']] = Namespace(**m)
+
+        missing_authors.clear()
+        for kind, counts in checkpoint['missing_authors'].items():
+            missing_authors[kind].update(counts)
+
+        # only messages added during the export, not the overrides
+        messages.added.clear()
+        for msg_id, body in checkpoint['messages']:
+            messages.setdefault(msg_id, body)
+
+        return True
+
+    def save(self):
+        if self.last_id is None:
+            return
+        # issues up to last_id must be written first
+        if issue_shards:
+            issue_shards.flush()
+        output_writer.flush()
+        with atomic_open(self.filename) as fp:
+            fp.write(dump_json({'config':          self.config_digest,
+                                'last_id':         self.last_id,
+                                'export_date':     options.export_date,
+                                'milestones':      milestones.values(),
+                                'missing_authors': missing_authors,
+                                'messages':        messages.added.items()}))
+        self.nr_unsaved = 0
+
+    def completed(self, summary):
+        self.last_id = int(summary['ID'])
+        self.nr_unsaved += 1
+
+    def due(self):
+        return bool(self.every) and self.nr_unsaved >= self.every
+
+    def remove(self):
+        # along with a temporary file left if interrupted while saving
+        for filename in self.filename, self.filename + '.tmp':
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
 
 
 def process_gcode_issues():
     """ Migrates all Google Code issues in the given dictionary to Github. """
 
-    issues = get_gcode_issue_summaries()
-
     if options.start_at is not None:
         output('Starting at issue {}'.format(options.start_at), level=1)
-        issues = [x for x in issues if int(x['ID']) >= options.start_at]
-
     if options.end_at is not None:
         output('End at issue {}'.format(options.end_at), level=1)
-        issues = [x for x in issues if int(x['ID']) <= options.end_at]
-
-    for summary in issues:
-        if options.skip_closed and summary['Closed']:
-            continue
 
-        issue = get_gcode_issue(summary)
-        add_issue_to_github(issue)
+    # Unless the issues are narrowed down, the total is known from the first
+    # CSV page. Otherwise it is known once all of them have been selected.
+    narrowed = (options.start_at is not None or options.end_at is not None or
+                options.skip_closed or checkpoint.last_id is not None)
+    def set_total(total):
+        if not narrowed:
+            progress.total = total
+
+    def count_issues(issues):
+        nr_issues = 0
+        for summary in issues:
+            nr_issues += 1
+            yield summary
+        progress.total = nr_issues
+
+    issues = select_gcode_issue_summaries(get_gcode_issue_summaries(set_total))
+    if checkpoint.last_id is not None:
+        issues = (x for x in issues if int(x['ID']) > checkpoint.last_id)
+    issues = count_issues(issues)
+
+    def fetch_changed_issue_page(summary):
+        entry = manifest and manifest.unchanged_entry(summary)
+        if entry:
+            return entry, None
+
+        # A cached page of an issue changed since the last export is stale
+        changed = manifest and summary['ID'] in manifest.old_entries
+        page = get_gcode_issue_page(summary, max_age=0 if changed else None)
+        link = GOOGLE_ISSUE_PAGE_URL.format(google_project_name, summary['ID'])
+        if parse_pool:
+            return None, parse_pool.apply_async(parse_gcode_issue_page, (page, link))
+        return None, parse_gcode_issue_page(page, link)
+
+    # Issues parsed so far, waiting for their attachments to be uploaded.
+    # These are written in order, and the checkpoint can only be saved
+    # when there are none, as parsing updates the global state.
+    pending = deque()
+    max_pending = 2 * options.attachment_workers
+
+    # Skipped issues bring their messages from the previous dump.
+    previous_ids = defaultdict(list)
+    for msg_id in previous_messages:
+        previous_ids[msg_id.partition('#')[0]].append(msg_id)
+
+    def finish_issues(max_pending=0):
+        while pending and (len(pending) > max_pending or
+                           not pending[0][1] or attachments_ready(pending[0][1])):
+            summary, issue = pending[0]
+
+            if issue:
+                add_issue_to_github(issue)
+                if manifest:
+                    manifest.record(summary, issue)
+            else:
+                link = GOOGLE_ISSUE_PAGE_URL.format(google_project_name, summary['ID'])
+                for msg_id in previous_ids.get(link, ()):
+                    if msg_id not in messages:
+                        messages[msg_id] = previous_messages[msg_id]
+
+            pending.popleft()
+            checkpoint.completed(summary)
+            progress.update()
+
+        if checkpoint.due() and not pending:
+            output('Saving checkpoint at issue {}'.format(checkpoint.last_id), level=2)
+            checkpoint.save()
+
+    # Pages are downloaded ahead by a pool of threads and parsed either by
+    # the same threads or by a pool of processes, while building issues,
+    # which updates global milestones and authors state, is kept in order.
+    in_progress = False
+    try:
+        for summary, (entry, page_record) in prefetch(fetch_changed_issue_page, issues,
+                                               workers=options.fetch_workers):
+            in_progress = True
+
+            if entry:
+                output('Skipping unchanged issue {}'.format(int(summary['ID'])), level=1)
+                stats.count('issues.skipped')
+                manifest.replay(summary, entry)
+                pending.append((summary, None))
+            else:
+                if parse_pool:
+                    page_record = page_record.get(WAIT_FOREVER)
+                pending.append((summary, get_gcode_issue(summary, page_record)))
+
+            in_progress = False
+            finish_issues(0 if checkpoint.due() else max_pending)
+
+        finish_issues()
+
+    except BaseException:
+        # Unless failed in the middle of an issue, e.g. while downloading
+        # the next page, the global state is consistent to save it once
+        # the issues parsed so far are written.
+        exc_info = sys.exc_info()
+        if not in_progress:
+            try:
+                finish_issues()
+                checkpoint.save()
+            except Exception as e:
+                output("Warning: unable to save checkpoint: {}".format(e))
+        raise exc_info[0], exc_info[1], exc_info[2]
 
     if milestones:
         for m in milestones.values():
             output('Adding milestone {}'.format(m.number), level=1)
-            write_json(m, 'out/milestones/{}.json'.format(m.number))
+            output_writer.write('out/milestones/{}.json'.format(m.number),
+                                dump_json(m, options.compact_json))
+
+    if issue_shards:
+        issue_shards.flush()
+    output_writer.flush()
+    checkpoint.remove()
 
 
 def get_milestone(label, initializing=False):
@@ -900,6 +2009,38 @@ def init_milestones(milestone_label_map):
             milestone.description = description
 
 
+def export_config_digest(with_export_date=True):
+    """ Digest of options and included files affecting the output. """
+    digest = hashlib.sha1(json.dumps([
+        google_project_name,
+        options.github_repo,
+        options.members,
+        options.absolute_links,
+        options.issues_start_from,
+        options.milestones_start_from,
+        options.export_date if with_export_date else None,
+        options.imported_label,
+        options.milestone_label_prefix,
+        options.milestone_label_date_format,
+        options.create_missing_milestones,
+        options.compact_json,
+        options.shard_size,
+    ]))
+
+    for filename in ([options.authors_json, options.labels_ini,
+                      options.messages_input] + options.commits_map):
+        if not filename:
+            continue
+        try:
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), ''):
+                    digest.update(chunk)
+        except IOError:
+            pass
+
+    return digest.hexdigest()
+
+
 def config_section(config, section_name):
     section = OrderedDict()
     for option in config.options(section_name):
@@ -924,45 +2065,120 @@ def read_ini(filename, *section_names):
     sections.__dict__ = sections_dict
     return sections
 
-def read_messages(filename):
-    messages = OrderedDict()
+class MessageStore(object):
+    """
+    Message bodies by ID, taken from a messages file, if any, and added
+    during the export. The file is only indexed when opened, recording
+    offsets of the bodies following each '<!--  id   md5  -->' marker line,
+    and the bodies are read on lookup. Iterating lists IDs from the file
+    first, in order, followed by the added ones.
+    """
 
-    msg_id = None
-    with codecs.open(filename, "r", encoding='utf-8') as f:
-        for line in f:
+    def __init__(self, filename=None):
+        super(MessageStore, self).__init__()
+        self.index = OrderedDict()  # msg_id -> [(offset, length)] in the file
+        self.added = OrderedDict()  # msg_id -> body
+        self.lock = threading.Lock()
+
+        self.fp = None
+        if filename:
+            self.fp = open(filename, 'rb')
+            self._build_index()
+
+    def _build_index(self):
+        segments = None  # of the current message, None before the first marker
+        offset = 0
+        for line in self.fp:
             frags = line.split(None, 4)
             if len(frags) == 4:
                 start, mb_msg_id, checksum, end = frags
                 if (start == '<!--' and end == '-->' and
                     checksum == hashlib.md5(mb_msg_id).hexdigest()):
-                    msg_id = mb_msg_id
+                    # a repeated ID continues the body of the previous one
+                    segments = self.index.setdefault(mb_msg_id.decode('utf-8'), [])
+                    segments.append((offset + len(line), 0))
+                    offset += len(line)
                     continue
 
-            messages[msg_id] = messages.get(msg_id, '') + line
-        else:
-            messages.setdefault(msg_id, '')
-    messages.pop(None, None)
-
-    for msg_id, body in messages.items():
-        messages[msg_id] = body.strip()
+            if segments is not None:
+                segment_offset, length = segments[-1]
+                segments[-1] = (segment_offset, length + len(line))
+            offset += len(line)
+
+        # Like when the file was read as a whole, a message is listed from
+        # its first line and IDs without any lines are left out, except the
+        # last one, which stands for an empty message
+        listed = []
+        for msg_id, msg_segments in self.index.items():
+            lines = [segment for segment in msg_segments if segment[1]]
+            if lines:
+                listed.append((lines[0][0], msg_id))
+            elif msg_segments is segments:
+                listed.append((offset, msg_id))
+        self.index = OrderedDict((msg_id, self.index[msg_id])
+                                 for first, msg_id in sorted(listed))
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+
+    def __contains__(self, msg_id):
+        return msg_id in self.added or msg_id in self.index
+
+    def __getitem__(self, msg_id):
+        try:
+            return self.added[msg_id]
+        except KeyError:
+            pass
+
+        chunks = []
+        with self.lock:
+            for offset, length in self.index[msg_id]:
+                self.fp.seek(offset)
+                chunks.append(self.fp.read(length))
+        return ''.join(chunks).decode('utf-8').strip()
+
+    def __setitem__(self, msg_id, body):
+        self.added[msg_id] = body
+
+    def setdefault(self, msg_id, body):
+        if msg_id not in self:
+            self.added[msg_id] = body
+
+    def __len__(self):
+        return len(self.index) + sum(1 for msg_id in self.added
+                                     if msg_id not in self.index)
+
+    def __iter__(self):
+        for msg_id in self.index:
+            yield msg_id
+        for msg_id in self.added:
+            if msg_id not in self.index:
+                yield msg_id
+
+    def items(self):
+        return ((msg_id, self[msg_id]) for msg_id in self)
 
+def read_messages(filename):
+    messages = MessageStore(filename)
     output("Read {} overrides from {}".format(len(messages), filename))
-
     return messages
 
 def write_messages(messages, filename):
-    try:
-        os.rename(filename, filename + "-old")
-    except OSError:
-        pass
-
-    with codecs.open(filename, "w", encoding='utf-8') as f:
+    with atomic_open(filename) as fp:
+        f = codecs.getwriter('utf-8')(fp)
         for msg_id, body in messages.items():
             f.write('<!--  {}   {}  -->\n'
                     .format(msg_id, hashlib.md5(msg_id).hexdigest()))
             f.write(body)
             f.write('\n\n')
 
+        # the previous file is kept until the new one is complete
+        try:
+            os.rename(filename, filename + "-old")
+        except OSError:
+            pass
+
 
 # Reasonable defaults for config options.
 CONFIG_DEFAULT_INI = """
@@ -971,6 +2187,13 @@ project
 start-at
 end-at
 skip-closed = false
+fetch-workers = 8
+parse-workers = 0
+http-cache
+http-cache-max-age
+retries = 5
+rate-limit
+connections-per-host = 8
 
 [github]
 repo
@@ -993,6 +2216,15 @@ milestone-label-prefix = Milestone
 milestone-label-date-format = %Y-%m-%d
 create-missing-milestones = true
 cache-attachments = true
+attachments-store = .attachments
+attachment-workers = 4
+gist-workers = 2
+incremental = false
+checkpoint-every = 100
+progress = 0
+stats-file
+compact-json = false
+shard-size = 0
 
 """.format(now=datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
 
@@ -1001,17 +2233,32 @@ def main():
     global options, google_project_name
     global milestones
     global author_map
+    global author_index
     global open_labels
     global closed_labels
     global label_map
+    global label_resolutions
     global commit_map
+    global ref_re
     global messages
     global attachments_cache
+    global parse_pool
+    global attachment_store
+    global attachments_pool
+    global gist_uploads
+    global http
+    global manifest
+    global previous_messages
+    global checkpoint
+    global progress
+    global issue_shards
+    global output_writer
 
     config = RawConfigParser(allow_no_value=True)
     config.optionxform = str
 
     config.readfp(io.BytesIO(CONFIG_DEFAULT_INI))
+    default_export_date = config.get('github', 'export-date')
     config.read('config.ini')
 
     parser = optparse.OptionParser(
@@ -1029,6 +2276,36 @@ def main():
     google.add_option('--skip-closed', action='store_true',
             default=config.getboolean('google', 'skip-closed'),
             help='Skip all closed bugs')
+    google.add_option('--fetch-workers', type=int,
+            default=config.get('google', 'fetch-workers'),
+            help='Number of issue pages to download concurrently')
+    google.add_option('--parse-workers', type=int,
+            default=config.get('google', 'parse-workers'),
+            help='Number of processes to parse issue pages with, 0 to use threads')
+
+    google.add_option('--http-cache',
+            default=config.get('google', 'http-cache'),
+            help='Directory to cache downloaded pages in')
+    google.add_option('--no-http-cache', action='store_const', const='',
+            dest='http_cache',
+            help='Neither use nor populate the cache of downloaded pages')
+    google.add_option('--http-cache-max-age', type=float,
+            default=config.get('google', 'http-cache-max-age'),
+            help='Download again pages cached earlier than given hours ago')
+    google.add_option('--offline', action='store_true', default=False,
+            help='Use cached pages only, never access the network')
+    google.add_option('--refresh', action='store_true', default=False,
+            help='Download all pages again and update the cache')
+
+    google.add_option('--retries', type=int,
+            default=config.get('google', 'retries'),
+            help='Number of retries of failed requests, with exponential backoff')
+    google.add_option('--rate-limit', type=float,
+            default=config.get('google', 'rate-limit'),
+            help='Maximum number of requests per second to each host')
+    google.add_option('--connections-per-host', type=int,
+            default=config.get('google', 'connections-per-host'),
+            help='Maximum number of keep-alive connections to each host')
 
     parser.add_option_group(google)
 
@@ -1104,6 +2381,39 @@ def main():
             dest='cache_attachments',
             default=config.getboolean('misc', 'cache-attachments'),
             help='Download all attachments and create new Gists from scratch')
+    misc.add_option('--attachments-store',
+            default=config.get('misc', 'attachments-store'),
+            help='Directory to keep downloaded attachment files in')
+    misc.add_option('--attachment-workers', type=int,
+            default=config.get('misc', 'attachment-workers'),
+            help='Number of messages to download attachments of in parallel')
+    misc.add_option('--gist-workers', type=int,
+            default=config.get('misc', 'gist-workers'),
+            help='Maximum number of Gists to upload concurrently')
+
+    misc.add_option('--incremental', action='store_true',
+            default=config.getboolean('misc', 'incremental'),
+            help='Only export issues changed since the previous run')
+
+    misc.add_option('--checkpoint-every', type=int,
+            default=config.get('misc', 'checkpoint-every'),
+            help='Save progress every given number of issues')
+    misc.add_option('--resume', action='store_true', default=False,
+            help='Resume an interrupted export from the last checkpoint')
+
+    misc.add_option('--compact-json', action='store_true',
+            default=config.getboolean('misc', 'compact-json'),
+            help='Write output JSON files without indentation')
+    misc.add_option('--shard-size', type=int,
+            default=config.get('misc', 'shard-size'),
+            help='Write issues into NDJSON files of given number of issues each')
+
+    misc.add_option('--progress', type=float,
+            default=config.get('misc', 'progress'),
+            help='Report progress every given number of seconds')
+    misc.add_option('--stats-file',
+            default=config.get('misc', 'stats-file'),
+            help='Save timings of export stages and counters to a JSON file')
 
     parser.add_option_group(misc)
 
@@ -1127,14 +2437,34 @@ def main():
         parser.print_help()
         sys.exit(1)
 
+    ref_re = re.compile(REF_RE_TMPL.format(google_project_name))
+
     if not options.github_repo:
         options.github_repo = '{0}/{0}'.format(google_project_name)
         output("Note: GitHub repo name is set to '{}'"
                .format(options.github_repo))
 
+    if options.offline and not options.http_cache:
+        output("Error: --offline requires an HTTP cache")
+        sys.exit(1)
+
+    http = httpfetch.Fetcher(
+            cache=(httpfetch.ResponseCache(options.http_cache)
+                   if options.http_cache else None),
+            offline=options.offline, refresh=options.refresh,
+            max_age=(options.http_cache_max_age * 3600
+                     if options.http_cache_max_age is not None else None),
+            retries=options.retries, rate=options.rate_limit,
+            connections=options.connections_per_host,
+            log=lambda message: output(message, level=1),
+            stats=stats)
+
+    progress = instrument.Progress(options.progress, output)
+
     author_map = {}
     if options.authors_json:
         author_map.update(read_json(options.authors_json))
+    author_index = AuthorIndex(author_map)
 
     label_map = {}
     if options.labels_ini:
@@ -1157,6 +2487,10 @@ def main():
         open_labels   = {}
         closed_labels = {}
 
+    label_resolutions = {}
+    for label in label_map:
+        resolve_label(label)
+
     commit_map = {}
     for map_filename in reversed(options.commits_map):
         tmp_map = commit_map
@@ -1172,17 +2506,73 @@ def main():
     for dir_ in 'out', 'out/issues', 'out/milestones':
         if not os.path.exists(dir_):
             os.mkdir(dir_)
+        remove_tmp_files(dir_)
+
+    # Forked before starting any threads, once the state used for parsing
+    # (the commits map and options) is set
+    parse_pool = None
+    if options.parse_workers > 0:
+        parse_pool = multiprocessing.Pool(options.parse_workers, init_parse_worker)
+
+    output_writer = OutputWriter()
+
+    issue_shards = None
+    if options.shard_size > 0:
+        issue_shards = IssueShards('out/issues', options.shard_size, output_writer)
 
     if options.messages_input:
         messages = read_messages(options.messages_input)
     else:
-        messages = OrderedDict()
+        messages = MessageStore()
+
+    checkpoint = ExportCheckpoint('.export-checkpoint.json',
+                                  hashlib.sha1(json.dumps([
+                                      export_config_digest(with_export_date=False),
+                                      options.start_at,
+                                      options.end_at,
+                                      options.skip_closed,
+                                      options.incremental,
+                                  ])).hexdigest(),
+                                  options.checkpoint_every)
+    if options.resume:
+        if not checkpoint.exists():
+            output("Error: No checkpoint to resume from")
+            sys.exit(1)
+        if not checkpoint.load():
+            output("Error: The checkpoint was saved with different options")
+            sys.exit(1)
+        # Unless given, the export date is the one of the interrupted export
+        if options.export_date == default_export_date:
+            options.export_date = checkpoint.export_date
+        elif options.export_date != checkpoint.export_date:
+            output("Error: The checkpoint was saved with export date {}, "
+                   "resume with the same one or none"
+                   .format(checkpoint.export_date))
+            sys.exit(1)
+        output('Resuming after issue {}'.format(checkpoint.last_id))
+    elif checkpoint.exists():
+        output("Note: Starting from scratch, use --resume to continue "
+               "the interrupted export")
+
+    config_digest = export_config_digest()
+
+    manifest = None
+    previous_messages = MessageStore()
+    if options.incremental:
+        manifest = ExportManifest('.export-manifest.json', config_digest)
+
+        if options.messages_output and os.path.exists(options.messages_output):
+            previous_messages = MessageStore(options.messages_output)
 
     if options.cache_attachments:
-        try:
-            attachments_cache = read_json('.attachments-cache.json')
-        except IOError:
-            attachments_cache = {}
+        attachments_cache = JournaledDict('.attachments-cache.json')
+    else:
+        attachments_cache = {}
+
+    attachment_store = AttachmentStore(options.attachments_store,
+                                       reuse=options.cache_attachments)
+    attachments_pool = ThreadPool(max(options.attachment_workers, 1))
+    gist_uploads = threading.BoundedSemaphore(max(options.gist_workers, 1))
 
     try:
         process_gcode_issues()
@@ -1191,13 +2581,46 @@ def main():
         parser.print_help()
         raise
     finally:
+        if parse_pool:
+            parse_pool.terminate()
+            parse_pool.join()
+        attachments_pool.terminate()
+        attachments_pool.join()
+        if options.cache_attachments:
+            try:
+                attachments_cache.close()
+            except (IOError, OSError):
+                output("Warning: unable to save attachments cache")
         try:
-            write_json(attachments_cache, '.attachments-cache.json')
-        except IOError:
-            output("Warning: unable to save attachments cache")
+            attachment_store.close()
+        except (IOError, OSError):
+            output("Warning: unable to save attachments store index")
+        try:
+            if issue_shards:
+                issue_shards.flush()
+            output_writer.close()
+        except (IOError, OSError) as e:
+            output("Warning: unable to write output files: {}".format(e))
+        if manifest:
+            try:
+                manifest.save()
+            except IOError:
+                output("Warning: unable to save export manifest")
+        http.close()
+
+        output()
+        for line in stats.summary():
+            output(line)
+        if options.stats_file:
+            try:
+                stats.save(options.stats_file)
+            except IOError:
+                output("Warning: unable to save statistics")
 
     if options.messages_output:
         write_messages(messages, options.messages_output)
+    messages.close()
+    previous_messages.close()
 
     missing_authors_total = Counter()
     for author_kind, counts in (sorted(missing_authors.items()) +
@@ -0,0 +1,523 @@
+"""
+HTTP fetching layer shared by the scripts: an on-disk cache of responses,
+retries with exponential backoff, per-host request rate limits and a pool
+of keep-alive connections.
+"""
+
+import base64
+import contextlib
+import collections
+import email.utils
+import errno
+import gzip
+import hashlib
+import httplib
+import io
+import json
+import os
+import random
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+import instrument
+
+
+class Response(object):
+    """
+    A fully read response body along with its content type.
+    """
+
+    def __init__(self, url, body, content_type=None, from_cache=False):
+        super(Response, self).__init__()
+        self.url = url
+        self.body = body
+        self.content_type = content_type
+        self.from_cache = from_cache
+
+    @property
+    def charset(self):
+        if self.content_type and 'charset=' in self.content_type:
+            return self.content_type.split('charset=')[-1].strip()
+
+
+class NotCachedError(urllib2.URLError):
+    """
+    Raised in offline mode for URLs missing in the cache.
+    """
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+class ResponseCache(object):
+    """
+    Content-addressed store of response bodies keyed by URL.
+
+    Bodies are kept gzipped under 'objects/', named after their SHA-1, so that
+    identical pages share a single file. The 'index' file is an append-only
+    log of (url, digest, timestamp, content_type) records, the latest record
+    of each URL wins. The log is compacted on load once it grows too stale.
+    """
+
+    INDEX_FILE   = 'index'
+    OBJECTS_DIR  = 'objects'
+
+    def __init__(self, path):
+        super(ResponseCache, self).__init__()
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        objects_dir = os.path.join(path, self.OBJECTS_DIR)
+        if not os.path.isdir(objects_dir):
+            os.makedirs(objects_dir)
+        self._remove_tmp_files(objects_dir)
+
+        self._load_index()
+        self.index_fp = open(self._index_filename(), 'a')
+
+    @staticmethod
+    def _remove_tmp_files(objects_dir):
+        """ Removes temporary files left by an interrupted run. """
+        for dirname in os.listdir(objects_dir):
+            dirname = os.path.join(objects_dir, dirname)
+            if os.path.isdir(dirname):
+                for name in os.listdir(dirname):
+                    if name.endswith('.tmp'):
+                        _remove(os.path.join(dirname, name))
+
+    def _index_filename(self):
+        return os.path.join(self.path, self.INDEX_FILE)
+
+    def _object_filename(self, digest):
+        return os.path.join(self.path, self.OBJECTS_DIR, digest[:2], digest[2:] + '.gz')
+
+    def _load_index(self):
+        nr_records = 0
+        try:
+            with open(self._index_filename(), 'r') as f:
+                for line in f:
+                    try:
+                        url, digest, timestamp, content_type = json.loads(line)
+                    except ValueError:
+                        continue  # a partially written record, if interrupted
+                    self.entries[url] = (digest, timestamp, content_type)
+                    nr_records += 1
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        if nr_records > 2 * len(self.entries) + 1000:
+            self._compact_index()
+
+    def _compact_index(self):
+        tmp_filename = self._index_filename() + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                for url, entry in self.entries.items():
+                    f.write(json.dumps([url] + list(entry)) + '\n')
+            os.rename(tmp_filename, self._index_filename())
+        except (IOError, OSError):
+            _remove(tmp_filename)
+            raise
+
+    def close(self):
+        self.index_fp.close()
+
+    def get(self, url, max_age=None):
+        """
+        Returns a cached Response, or None if there is no entry for the URL
+        or it is older than max_age seconds.
+        """
+        try:
+            digest, timestamp, content_type = self.entries[url]
+        except KeyError:
+            return
+
+        if max_age is not None and time.time() - timestamp > max_age:
+            return
+
+        try:
+            with contextlib.closing(gzip.open(self._object_filename(digest), 'rb')) as f:
+                body = f.read()
+        except IOError:
+            return
+
+        return Response(url, body, content_type, from_cache=True)
+
+    def put(self, response):
+        digest = hashlib.sha1(response.body).hexdigest()
+
+        filename = self._object_filename(digest)
+        if not os.path.exists(filename):
+            dirname = os.path.dirname(filename)
+            try:
+                os.mkdir(dirname)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            tmp_filename = '{}.{}.tmp'.format(filename, threading.current_thread().ident)
+            try:
+                with contextlib.closing(gzip.open(tmp_filename, 'wb')) as f:
+                    f.write(response.body)
+                os.rename(tmp_filename, filename)
+            except (IOError, OSError):
+                _remove(tmp_filename)
+                raise
+
+        entry = (digest, time.time(), response.content_type)
+        with self.lock:
+            self.entries[response.url] = entry
+            self.index_fp.write(json.dumps([response.url] + list(entry)) + '\n')
+            self.index_fp.flush()
+
+
+class TokenBucket(object):
+    """
+    Limits requests to a sustained rate per second, allowing bursts of up to
+    'burst' requests. Without a rate it only holds requests deferred after
+    the server has asked to retry later.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        super(TokenBucket, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.timestamp = time.time()
+        self.not_before = 0
+        self.lock = threading.Lock()
+
+    def defer(self, delay):
+        with self.lock:
+            self.not_before = max(self.not_before, time.time() + delay)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.not_before:
+                    delay = self.not_before - now
+                elif not self.rate:
+                    return
+                else:
+                    self.tokens = min(self.burst,
+                                      self.tokens + (now - self.timestamp) * self.rate)
+                    self.timestamp = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+def parse_retry_after(value):
+    """ Returns the delay in seconds given by a Retry-After header, if any. """
+    if not value:
+        return
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date:
+            return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+class ConnectionPool(object):
+    """
+    Reuses keep-alive connections, keeping up to 'maxsize' connections
+    to each host. Requests beyond that wait for a connection to be released.
+
+    Like urllib2, it follows redirects and raises HTTPError for error
+    responses, and URLError on network errors. It also goes through the
+    proxies given by the environment (http_proxy, https_proxy, no_proxy),
+    tunneling https requests with CONNECT.
+    """
+
+    MAX_REDIRECTS = 10
+
+    USER_AGENT = 'Python-urllib/' + urllib2.__version__
+
+    def __init__(self, maxsize=8, timeout=60, proxies=None):
+        super(ConnectionPool, self).__init__()
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.proxies = urllib.getproxies() if proxies is None else proxies
+        self.idle = collections.defaultdict(list)
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+
+    def _semaphore(self, key):
+        with self.lock:
+            try:
+                return self.semaphores[key]
+            except KeyError:
+                return self.semaphores.setdefault(key, threading.BoundedSemaphore(self.maxsize))
+
+    def _proxy(self, parsed):
+        """ Returns (host, Proxy-Authorization header) of the proxy to use, if any. """
+        proxy = self.proxies.get(parsed.scheme)
+        if not proxy or urllib.proxy_bypass(parsed.hostname or ''):
+            return None, None
+
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        proxy = urlparse.urlsplit(proxy)
+        host = proxy.netloc.rpartition('@')[2]
+        authorization = None
+        if proxy.username is not None:
+            credentials = '{}:{}'.format(urllib.unquote(proxy.username),
+                                         urllib.unquote(proxy.password or ''))
+            authorization = 'Basic ' + base64.b64encode(credentials)
+        return host, authorization
+
+    def _get_connection(self, key):
+        """ Returns an idle connection, if any, or a new one. """
+        with self.lock:
+            if self.idle[key]:
+                return self.idle[key].pop(), True
+
+        scheme, host, proxy, authorization = key
+        if scheme == 'https':
+            if proxy:
+                connection = httplib.HTTPSConnection(proxy, timeout=self.timeout)
+                connection.set_tunnel(host, headers=(
+                    {'Proxy-Authorization': authorization} if authorization else None))
+                return connection, False
+            return httplib.HTTPSConnection(host, timeout=self.timeout), False
+        return httplib.HTTPConnection(proxy or host, timeout=self.timeout), False
+
+    def _put_connection(self, key, connection):
+        with self.lock:
+            self.idle[key].append(connection)
+
+    def _request_once(self, method, url, data, headers, idempotent):
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme not in ('http', 'https'):
+            raise urllib2.URLError('Unsupported URL scheme: ' + url)
+        proxy, authorization = self._proxy(parsed)
+        key = (parsed.scheme, parsed.netloc, proxy, authorization)
+        if proxy and parsed.scheme == 'http':
+            # Plain requests are sent to the proxy with the whole URL
+            path = urlparse.urlunsplit(parsed[:2] + (parsed.path or '/', parsed.query, ''))
+            if authorization:
+                headers = dict(headers, **{'Proxy-Authorization': authorization})
+        else:
+            path = urlparse.urlunsplit(('', '', parsed.path or '/', parsed.query, ''))
+
+        with self._semaphore(key):
+            connection, reused = self._get_connection(key)
+            try:
+                try:
+                    connection.request(method, path, data, headers)
+                    response = connection.getresponse()
+                except (httplib.HTTPException, socket.error) as e:
+                    # The server may have closed the idle connection, which
+                    # is only found out after sending the request. Unless it
+                    # is idempotent, resend the request only if the server
+                    # has closed the connection without responding.
+                    connection.close()
+                    if not reused or not (idempotent or
+                                          isinstance(e, httplib.BadStatusLine)):
+                        raise
+                    connection, reused = self._get_connection(key)
+                    connection.request(method, path, data, headers)
+                    response = connection.getresponse()
+
+                body = response.read()
+
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                raise urllib2.URLError(e)
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._put_connection(key, connection)
+
+        return response, body
+
+    def request(self, method, url, data=None, headers=None, idempotent=True):
+        """
+        Returns an (httplib.HTTPResponse, body) pair, the response is read
+        and its connection is released back to the pool already.
+        """
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', self.USER_AGENT)
+
+        for _ in xrange(self.MAX_REDIRECTS + 1):
+            response, body = self._request_once(method, url, data, headers, idempotent)
+
+            if response.status in (301, 302, 303, 307):
+                location = response.getheader('Location')
+                if location and (method in ('GET', 'HEAD') or response.status != 307):
+                    url = urlparse.urljoin(url, location)
+                    if method not in ('GET', 'HEAD'):
+                        # Like browsers and urllib2 do, redirect as a GET.
+                        method, data = 'GET', None
+                        headers.pop('Content-Type', None)
+                    continue
+
+            if response.status >= 400 or response.status in (301, 302, 303, 307):
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.msg, io.BytesIO(body))
+            return response, body
+
+        raise urllib2.HTTPError(url, response.status, 'Too many redirects',
+                                response.msg, io.BytesIO(body))
+
+
+# Responses worth retrying
+RETRY_HTTP_CODES = (429, 502, 503, 504)
+
+# Responses refusing to handle the request, which can be retried even if it
+# is not idempotent: a gateway error doesn't tell whether it has been handled
+REFUSED_HTTP_CODES = (429, 503)
+
+class Fetcher(object):
+    """
+    Performs GET requests through an optional ResponseCache.
+
+    In offline mode the network is never touched and a NotCachedError is
+    raised for anything not in the cache. In refresh mode cached entries
+    are ignored, but fresh responses still update the cache.
+
+    Failed requests are retried up to 'retries' times, sleeping for a random
+    time up to 'backoff' seconds, doubled on each attempt (but no more than
+    'max_backoff'), or as long as the Retry-After header says. Requests
+    to each host are limited to 'rate' per second, if given.
+
+    Requests are sent over keep-alive connections, up to 'connections'
+    per host, shared by all threads using the same Fetcher.
+
+    Request times, bytes downloaded, cache hits and retries are accounted
+    in 'stats', an instrument.Stats instance, under 'http.' names.
+    """
+
+    def __init__(self, cache=None, offline=False, refresh=False, max_age=None,
+                 headers=None, retries=5, backoff=1.0, max_backoff=120.0,
+                 rate=None, burst=1, connections=8, timeout=60, log=None,
+                 stats=None):
+        super(Fetcher, self).__init__()
+        self.cache   = cache
+        self.offline = offline
+        self.refresh = refresh
+        self.max_age = max_age
+        self.headers = dict(headers or {})
+
+        self.retries     = retries
+        self.backoff     = backoff
+        self.max_backoff = max_backoff
+        self.log         = log or (lambda message: None)
+        self.stats       = stats or instrument.Stats()
+
+        self.pool = ConnectionPool(connections, timeout)
+
+        self.rate  = rate
+        self.burst = burst
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+
+    def close(self):
+        self.pool.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def get(self, url, headers=None, max_age=None):
+        if max_age is None:
+            max_age = self.max_age
+
+        if self.cache is not None and not self.refresh:
+            # There is nothing better to serve offline than a stale entry.
+            response = self.cache.get(url, max_age if not self.offline else None)
+            if response is not None:
+                self.stats.count('http.cache_hits')
+                return response
+
+        if self.offline:
+            raise NotCachedError('Not cached (working offline): ' + url)
+
+        response = self._request('GET', url, None, headers, idempotent=True)
+
+        if self.cache is not None:
+            self.cache.put(response)
+
+        return response
+
+    def post(self, url, data, headers=None):
+        if self.offline:
+            raise urllib2.URLError('Unable to POST (working offline): ' + url)
+
+        return self._request('POST', url, data, headers, idempotent=False)
+
+    def _headers(self, headers):
+        all_headers = dict(self.headers)
+        if headers:
+            all_headers.update(headers)
+        return all_headers
+
+    def _bucket(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self.buckets_lock:
+            try:
+                return self.buckets[host]
+            except KeyError:
+                return self.buckets.setdefault(host, TokenBucket(self.rate, self.burst))
+
+    def _request(self, method, url, data, headers, idempotent):
+        """
+        Retries the request on server errors and network errors if it is
+        idempotent, i.e. there is no harm in sending it twice, otherwise
+        only when the server has refused to handle it.
+        """
+        headers = self._headers(headers)
+        bucket = self._bucket(url)
+
+        for attempt in xrange(self.retries + 1):
+            with self.stats.timer('http.rate_wait'):
+                bucket.acquire()
+            try:
+                self.stats.count('http.requests')
+                with self.stats.timer('http.request'):
+                    response, body = self.pool.request(method, url, data, headers,
+                                                       idempotent)
+                self.stats.count('http.bytes', len(body))
+                return Response(url, body, response.getheader('Content-Type'))
+
+            except urllib2.HTTPError as e:
+                if attempt >= self.retries or e.code not in (
+                        RETRY_HTTP_CODES if idempotent else REFUSED_HTTP_CODES):
+                    raise
+                error = e
+                delay = parse_retry_after(e.info().getheader('Retry-After'))
+            except urllib2.URLError as e:
+                if attempt >= self.retries or not idempotent:
+                    raise
+                error = e
+                delay = None
+
+            if delay is None:
+                delay = random.uniform(0, min(self.max_backoff,
+                                              self.backoff * 2 ** attempt))
+            self.log("Retrying in {:.1f}s ({}/{}) after {}: {}"
+                     .format(delay, attempt + 1, self.retries, error, url))
+            self.stats.count('http.retries')
+
+            # Back off with all requests to the host, not just this one
+            bucket.defer(delay)
@@ -0,0 +1,119 @@
+"""
+Timers, counters and progress reporting shared by the export and
+migration scripts.
+"""
+
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import timedelta
+
+
+class Stats(object):
+    """
+    Named timers and counters accumulated over a run, safe to update from
+    multiple threads. Names are dotted, e.g. 'http.bytes', so that related
+    ones are listed together.
+    """
+
+    def __init__(self):
+        super(Stats, self).__init__()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.timers = {}    # name -> [calls, total, max]
+        self.counters = {}  # name -> value
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'elapsed':  time.time() - self.started,
+                'timers':   dict((name, {'calls': calls, 'total': total, 'max': max_})
+                                 for name, (calls, total, max_) in self.timers.items()),
+                'counters': dict(self.counters),
+            }
+
+    def summary(self):
+        """ Returns lines of a table listing all timers and counters. """
+        stats = self.as_dict()
+
+        lines = ['{:<32} {:>10} {:>10} {:>10} {:>10}'
+                 .format('Timer', 'calls', 'total s', 'avg ms', 'max ms')]
+        for name, timer in sorted(stats['timers'].items()):
+            lines.append('{:<32} {:>10} {:>10.3f} {:>10.3f} {:>10.3f}'
+                         .format(name, timer['calls'], timer['total'],
+                                 timer['total'] / timer['calls'] * 1e3,
+                                 timer['max'] * 1e3))
+
+        lines.append('{:<32} {:>10}'.format('Counter', 'value'))
+        for name, value in sorted(stats['counters'].items()):
+            lines.append('{:<32} {:>10}'.format(name, value))
+
+        lines.append('{:<32} {:>10.3f}'.format('Elapsed, s', stats['elapsed']))
+        return lines
+
+    def save(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump(self.as_dict(), fp, indent=4, separators=(',', ': '),
+                      sort_keys=True)
+            fp.write('\n')
+
+
+class Progress(object):
+    """
+    Reports the number of items done, at most once per given number of
+    seconds (never if it is 0), with the estimated time remaining once
+    the total is known.
+    """
+
+    def __init__(self, interval=0, write=None, unit='issues', total=None):
+        super(Progress, self).__init__()
+        self.interval = interval
+        self.write = write
+        self.unit = unit
+        self.total = total
+        self.done = 0
+        self.started = self.reported = time.time()
+
+    def update(self, done=1):
+        self.done += done
+        if not self.interval:
+            return
+
+        now = time.time()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.write(self.format(now - self.started))
+
+    def format(self, elapsed):
+        rate = self.done / elapsed if elapsed else 0.0
+
+        line = 'Progress: {} {}'.format(self.done, self.unit)
+        if self.total:
+            line += ' of {} ({:.0%})'.format(self.total,
+                                             min(float(self.done) / self.total, 1))
+        line += ', {:.2f}/s'.format(rate)
+        if self.total and rate:
+            remaining = max(self.total - self.done, 0) / rate
+            line += ', ETA {}'.format(timedelta(seconds=int(remaining)))
+        return line
@@ -16,13 +16,15 @@ import atom.core
 import gdata.data
 
 import json
-import urllib2
+import io
 import base64
 import getpass
 import csv
 import optparse
 import sys
 
+import httpfetch
+
 ## Based substantially on live_client_test from the Google Code Project Hosting
 ## API example, available here.
 ## http://code.google.com/p/gdata-python-client/ ...
@@ -34,13 +36,13 @@ GOOGLE_ISSUES_URL = 'https://code.google.com/p/{}/issues/csv?can=1&num={}&start=
 ### Code to interact with Google Code Project Hosting
 ###
 
-def get_gcode_issues(google_project_name):
+def get_gcode_issues(http, google_project_name):
     count = 100
     start_index = 0
     issues = []
     while True:
         url = GOOGLE_ISSUES_URL.format(google_project_name, count, start_index)
-        issues.extend(row for row in csv.DictReader(urllib2.urlopen(url), dialect=csv.excel))
+        issues.extend(row for row in csv.DictReader(io.BytesIO(http.get(url).body), dialect=csv.excel))
 
         if issues and 'truncated' in issues[-1]['ID']:
             issues.pop()
@@ -73,6 +75,8 @@ def main():
     parser.add_option('--google-username', dest = 'google_username', help = 'google username', default = None, type = str)
     parser.add_option('--github-org', dest = 'github_org', help = 'github organisation', default = None, type = str)
     parser.add_option('--github-project', dest = 'github_project', help = 'github project', default = None, type = str)
+    parser.add_option('--retries', dest = 'retries', help = 'Number of retries of failed Google Code requests', default = 5, type = int)
+    parser.add_option('--rate-limit', dest = 'rate_limit', help = 'Maximum number of Google Code requests per second', default = None, type = float)
 
     options, args = parser.parse_args()
 
@@ -96,7 +100,10 @@ def main():
     client = gdata.projecthosting.client.ProjectHostingClient()
     client.ClientLogin(google_username, google_password, source=application_name)
 
-    issues = [x for x in get_gcode_issues(google_project_name) if int(x['ID']) >= options.start_at]
+    http = httpfetch.Fetcher(retries=options.retries, rate=options.rate_limit,
+                             log=lambda message: print(message, file=sys.stderr))
+
+    issues = [x for x in get_gcode_issues(http, google_project_name) if int(x['ID']) >= options.start_at]
 
     delta = options.issues_start_from - 1
 
@@ -1,21 +1,28 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import calendar
 import csv
 import getpass
+import hashlib
+import io
 import logging
 import optparse
 import re
+import sqlite3
 import sys
-import urllib2
 import time
 
+from collections import Counter
 from datetime import datetime
 
 from github import Github
 from github import GithubException
 from pyquery import PyQuery as pq
 
+import httpfetch
+import instrument
+
 logging.basicConfig(level = logging.ERROR)
 
 # The maximum number of records to retrieve from Google Code in a single request
@@ -28,11 +35,21 @@ GOOGLE_URL = 'http://code.google.com/p/{}/issues/detail?id={}'
 GOOGLE_URL_RE = 'http://code.google.com/p/%s/issues/detail\?id=(\d+)'
 GOOGLE_ID_RE = GOOGLE_ISSUE_TEMPLATE.format(GOOGLE_URL_RE)
 
+# Header of migrated comments, linking to the original comment if it has an anchor
+GOOGLE_COMMENT_HEADER = u'_From {author} on {date}_'
+GOOGLE_LINKED_COMMENT_HEADER = u'_From {author} on [{date}]({link}#{anchor})_'
+GOOGLE_COMMENT_ANCHOR_RE = r'_From [^\n]* on \[[^\n]*\]\(' + GOOGLE_URL_RE + r'#(\w+)\)_'
+
 # The minimum number of remaining Github rate-limited API requests before we pre-emptively
-# abort to avoid hitting the limit part-way through migrating an issue.
+# wait for the limit to reset, to avoid hitting it part-way through migrating an issue.
 
 GITHUB_SPARE_REQUESTS = 50
 
+# The number of Github requests migrating an issue takes besides posting its comments:
+# creating it, looking up labels and the milestone, listing comments and editing it.
+
+GITHUB_ISSUE_REQUESTS = 4
+
 # Mapping from Google Code issue labels to Github labels
 
 LABEL_MAPPING = {
@@ -118,6 +135,9 @@ def github_milestone(name):
         except KeyError:
             m = milestone_cache.setdefault(name, github_repo.create_milestone(name))
             milestone_number.setdefault(name, m.number)
+            if state_store:
+                state_store.set_milestone(name, m.number)
+                state_store.commit()
             return m
 
 def parse_gcode_date(date_text):
@@ -143,13 +163,6 @@ def dereferenceMention(content):
 def add_issue_to_github(issue):
     """ Migrates the given Google Code issue to Github. """
 
-    # Github rate-limits API requests to 5000 per hour, and if we hit that limit part-way
-    # through adding an issue it could end up in an incomplete state.  To avoid this we'll
-    # ensure that there are enough requests remaining before we start migrating an issue.
-
-    if github.rate_limiting[0] < GITHUB_SPARE_REQUESTS:
-        raise Exception('Aborting to to impending Github API rate-limit cutoff.')
-
     body = issue['content'].replace('%', '&#37;')
 
     output('Adding issue %d' % issue['gid'])
@@ -164,43 +177,234 @@ def add_issue_to_github(issue):
             issue['title'] = "(empty title)"
         text = body.encode('utf-8')
         text = transform_to_markdown_compliant(text)
-        github_issue = github_repo.create_issue(issue['title'], body = text, labels = github_labels, milestone = milestone)
+        with stats.timer('github.create_issue'):
+            github_issue = github_repo.create_issue(issue['title'], body = text, labels = github_labels, milestone = milestone)
+        stats.count('issues.created')
 
     # Assigns issues that originally had an owner to the current user
     if issue['owner'] and options.assign_owner:
         assignee = github.get_user(github_user.login)
         if not options.dry_run:
-            github_issue.edit(assignee = assignee)
+            with stats.timer('github.edit'):
+                github_issue.edit(assignee = assignee)
 
     return github_issue
 
 
+def get_rate_limit():
+    """ Returns the remaining requests, the limit and the time they reset at. """
+
+    # PyGithub 1.17 only keeps the remaining requests and the limit, and has
+    # no public way to ask for the reset time (Github.get_rate_limit() came in
+    # later versions), so /rate_limit is requested through its requester.
+    headers, data = github._Github__requester.requestJsonAndCheck('GET', '/rate_limit', None, None)
+    return data['rate']['remaining'], data['rate']['limit'], data['rate']['reset']
+
+
+class RateBudget(object):
+    """ Spreads Github requests evenly over the rate limit window.
+
+    Github rate-limits API requests to 5000 per hour, and if we hit that limit
+    part-way through adding an issue it could end up in an incomplete state.
+    So before each issue, if fewer requests remain than it may take, we wait
+    for the limit to reset. Otherwise we wait for as long as the requests made
+    for the previous issue would take if the remaining ones were spread evenly
+    over the rest of the window, so that we don't run out of them early.
+
+    The number of remaining requests comes with every response, but PyGithub
+    doesn't keep the reset time, so it is asked for once per window.
+    """
+
+    def __init__(self):
+        self.remaining = None
+        self.limit = None
+        self.reset = None           # timestamp of the end of the current window
+        self.last_remaining = None  # as of the previous reservation
+        self.last_time = None
+
+    def refresh(self):
+        # /rate_limit requests don't count against the limit
+        with stats.timer('github.rate_limit'):
+            self.remaining, self.limit, self.reset = get_rate_limit()
+        self.last_remaining = None
+
+    def update(self):
+        if self.reset is None or time.time() >= self.reset:
+            self.refresh()
+        else:
+            self.remaining = github.rate_limiting[0]
+
+    def reserve(self, cost):
+        """ Waits until the given number of requests can be made. """
+
+        self.update()
+
+        # An issue taking more requests than a whole window can only be started afresh
+        cost = min(cost, self.limit - GITHUB_SPARE_REQUESTS)
+        while self.remaining - GITHUB_SPARE_REQUESTS < cost:
+            delay = max(self.reset - time.time(), 0) + 1
+            output('Waiting %d seconds for the Github rate limit to reset\n' % delay)
+            with stats.timer('github.rate_wait'):
+                time.sleep(delay)
+            self.refresh()
+
+        now = time.time()
+        if self.last_remaining is not None:
+            used = max(self.last_remaining - self.remaining, 0)
+            interval = max(self.reset - now, 0) / max(self.remaining - GITHUB_SPARE_REQUESTS, 1)
+            delay = self.last_time + used * interval - now
+            if delay > 0:
+                with stats.timer('github.rate_wait'):
+                    time.sleep(delay)
+                now += delay
+
+        self.last_remaining = self.remaining
+        self.last_time = now
+
+
+class CommentPoster(object):
+    """ Posts comments so that Github lists them in the order they are posted.
+
+    Github orders comments by their creation time, which has a resolution of
+    one second, so comments created within the same second may get reordered.
+    Instead of sleeping for a fixed time after each comment, the next comment
+    of the same issue is posted as soon as the Github clock is surely past the
+    second in which the previous one was created.
+
+    The Github clock offset is bounded using each comment acknowledged: it
+    was created at some point between sending the request and receiving the
+    response, within the second given by its created_at. The bounds tighten
+    as more comments are posted, so that the wait adapts to the observed
+    round-trip times. It never lasts past a second after the response to
+    the previous comment.
+    """
+
+    def __init__(self):
+        self.min_offset = None  # of the Github clock relative to the local one
+        self.max_offset = None
+        self.last_issue = None
+        self.last_created = None  # timestamp of the last comment posted
+
+    def post(self, github_issue, body):
+        if self.last_issue == github_issue.number:
+            delay = self.last_created + 1 - self.min_offset - time.time()
+            if delay > 0:
+                with stats.timer('github.comment_wait'):
+                    time.sleep(delay)
+
+        sent = time.time()
+        with stats.timer('github.create_comment'):
+            comment = github_issue.create_comment(body)
+        received = time.time()
+
+        created = calendar.timegm(comment.created_at.utctimetuple())
+        min_offset, max_offset = created - received, created + 1 - sent
+        if self.min_offset is None or not (min_offset < self.max_offset and
+                                           self.min_offset < max_offset):
+            # first comment, or either clock has been adjusted meanwhile
+            self.min_offset, self.max_offset = min_offset, max_offset
+        else:
+            self.min_offset = max(self.min_offset, min_offset)
+            self.max_offset = min(self.max_offset, max_offset)
+
+        self.last_issue = github_issue.number
+        self.last_created = created
+        return comment
+
+
+def comment_digest(body):
+    """ Returns a digest identifying a comment by its body.
+
+    Line endings and trailing whitespace are normalized, as Github doesn't
+    necessarily return bodies exactly as they were posted.
+    """
+    if not isinstance(body, unicode):
+        body = body.decode('utf-8')
+    lines = [line.rstrip() for line in body.strip().splitlines()]
+    return hashlib.sha1(u'\n'.join(lines).encode('utf-8')).hexdigest()
+
+def comment_anchor(body):
+    """ Returns the anchor of the Google Code comment linked from the header, if any. """
+    match = re.match(GOOGLE_COMMENT_ANCHOR_RE % re.escape(google_project_name), body)
+    return match.group(2) if match else None
+
+class CommentIndex(object):
+    """ Comments of a Github issue, by digest of their bodies.
+
+    Comments migrated by this script are also known by the key of their
+    Google Code comment, so they are recognized even if the way their
+    bodies are rendered has changed since. The key comes from the anchor
+    linked from the comment header, and for comments split into several
+    parts, from the order in which they are listed.
+    """
+
+    def __init__(self):
+        self.digests = {}  # digest -> key, if known
+        self.keys = set()
+        self.parts = Counter()  # anchor -> number of parts listed
+
+    def __len__(self):
+        return len(self.digests)
+
+    def add(self, digest, key = None):
+        if key or digest not in self.digests:
+            self.digests[digest] = key
+        if key:
+            self.keys.add(key)
+
+    def add_listed(self, body):
+        """ Adds a comment listed from Github. """
+        key = comment_anchor(body)
+        if key:
+            part = self.parts[key]
+            self.parts[key] += 1
+            if part:
+                key = '{}.{}'.format(key, part)
+        self.add(comment_digest(body), key)
+
+    def has(self, digest, key = None):
+        return digest in self.digests or (key is not None and key in self.keys)
+
 def add_comments_to_issue(github_issue, gcode_issue):
     """ Migrates all comments from a Google Code issue to its Github copy. """
 
-    # Retrieve existing Github comments, to figure out which Google Code comments are new
-    existing_comments = [comment.body for comment in github_issue.get_comments()]
+    gid = gcode_issue['gid']
+
+    # Retrieve existing Github comments, to figure out which Google Code comments
+    # are new, unless the state store knows them already
+    existing_comments = state_store.comment_index(gid) if state_store else None
+    if existing_comments is None:
+        existing_comments = CommentIndex()
+        with stats.timer('github.get_comments'):
+            for comment in github_issue.get_comments():
+                existing_comments.add_listed(comment.body)
+        if state_store:
+            state_store.set_comments(gid, existing_comments)
 
     # Add any remaining comments to the Github issue
     output(", adding comments")
     for i, comment in enumerate(gcode_issue['comments']):
-        body = u'_From {author} on {date}_\n\n{body}'.format(**comment)
+        header = GOOGLE_LINKED_COMMENT_HEADER if comment['anchor'] else GOOGLE_COMMENT_HEADER
+        body = header.format(link = gcode_issue['link'], **comment) + u'\n\n' + comment['body']
         topost = transform_to_markdown_compliant(body)
-        if topost in existing_comments:
+        digest = comment_digest(topost)
+        # Comments migrated before their headers linked to the original ones
+        legacy_body = GOOGLE_COMMENT_HEADER.format(**comment) + u'\n\n' + comment['body']
+        legacy_digest = comment_digest(transform_to_markdown_compliant(legacy_body))
+        if (existing_comments.has(digest, comment['key']) or
+                existing_comments.has(legacy_digest)):
             logging.info('Skipping comment %d: already present', i + 1)
+            stats.count('comments.skipped')
         else:
             logging.info('Adding comment %d', i + 1)
             if not options.dry_run:
                 topost = topost.encode('utf-8')
-                github_issue.create_comment(topost)
-
-                # We use a delay to avoid comments being created on GitHub
-                # in the wrong order, due to network non-determinism.
-                # Without this delay, I consistently observed a full 1 in 3
-                # GoogleCode issue comments being reordered.
-                # XXX: querying GitHub in a loop to see when the comment has
-                # been posted may be faster, but will cut into the rate limit.
-                time.sleep(5)
+                comment_poster.post(github_issue, topost)
+                stats.count('comments.added')
+                existing_comments.add(digest, comment['key'])
+                if state_store:
+                    state_store.add_comment(gid, digest, comment['key'])
+                    state_store.commit()
             output('.')
 
 def get_attachments(link, attachments):
@@ -260,29 +464,32 @@ def get_gcode_issue(issue_summary):
     issue['labels'] = labels
 
     # Scrape the issue details page for the issue body and comments
-    opener = urllib2.build_opener()
-    if options.google_code_cookie:
-        opener.addheaders = [('Cookie', options.google_code_cookie)]
-    connection = opener.open(issue['link'])
-    encoding = connection.headers['content-type'].split('charset=')[-1]
+    with stats.timer('fetch.page'):
+        response = http.get(issue['link'])
+    start = time.time()
     # Pass "ignore" so malformed page data doesn't abort us
-    doc = pq(connection.read().decode(encoding, "ignore"))
+    doc = pq(response.body.decode(response.charset or 'utf-8', "ignore"))
 
     description = doc('.issuedescription .issuedescription')
     issue['author'] = get_author(description)
 
     issue['comments'] = []
-    def split_comment(comment, text):
+    def split_comment(comment, text, anchor = None):
         # Github has an undocumented maximum comment size (unless I just failed
         # to find where it was documented), so split comments up into multiple
-        # posts as needed.
+        # posts as needed. Each post is keyed by the anchor of the Google Code
+        # comment and its part number.
+        part = 0
         while text:
             comment['body'] = text[:7000]
+            comment['anchor'] = anchor
+            comment['key'] = anchor and (anchor if not part else '{}.{}'.format(anchor, part))
             text = text[7000:]
             if text:
                 comment['body'] += '...'
                 text = '...' + text
             issue['comments'].append(comment.copy())
+            part += 1
 
     split_comment(issue, dereferenceMention(description('pre').text()))
     issue['content'] = u'_From {author} on {date:%B %d, %Y %H:%M:%S}_\n\n{content}{attachments}\n\n{footer}'.format(
@@ -312,8 +519,10 @@ def get_gcode_issue(issue_summary):
         # Strip the placeholder text if there's any other updates
         body = body.replace('(No comment was entered for this change.)\n\n', '')
 
-        split_comment({'date': date, 'author': author}, body)
+        anchor = comment('a[name]').attr('name') or comment.attr('id')
+        split_comment({'date': date, 'author': author}, body, anchor)
 
+    stats.add_time('parse', time.time() - start)
     return issue
 
 def get_gcode_issues():
@@ -322,7 +531,9 @@ def get_gcode_issues():
     issues = []
     while True:
         url = GOOGLE_ISSUES_URL.format(google_project_name, count, start_index)
-        issues.extend(row for row in csv.DictReader(urllib2.urlopen(url), dialect=csv.excel))
+        with stats.timer('fetch.summaries'):
+            body = http.get(url).body
+        issues.extend(row for row in csv.DictReader(io.BytesIO(body), dialect=csv.excel))
 
         if issues and 'truncated' in issues[-1]['ID']:
             issues.pop()
@@ -346,7 +557,9 @@ def process_gcode_issues(existing_issues):
         issues = [x for x in issues if int(x['ID']) <= options.end_at]
         output('End at issue %d\n' % options.end_at)
 
+    progress.total = len(issues)
     for issue in issues:
+        progress.update()
         issue = get_gcode_issue(issue)
 
         if options.skip_closed and (issue['state'] == 'closed'):
@@ -361,56 +574,136 @@ def process_gcode_issues(existing_issues):
                 if gid in existing_issues:
                     continue
 
+                rate_budget.reserve(GITHUB_ISSUE_REQUESTS)
                 output('Creating dummy entry for missing issue %d\n' % gid)
                 title = 'Google Code skipped issue %d' % gid
                 body = '_Skipping this issue number to maintain synchronization with Google Code issue IDs._'
                 footer = GOOGLE_ISSUE_TEMPLATE.format(GOOGLE_URL.format(google_project_name, gid))
                 body += '\n\n' + footer
-                github_issue = github_repo.create_issue(title, body = body, labels = [github_label('imported')])
-                github_issue.edit(state = 'closed')
-                existing_issues[previous_gid] = github_issue
+                with stats.timer('github.create_issue'):
+                    github_issue = github_repo.create_issue(title, body = body, labels = [github_label('imported')])
+                with stats.timer('github.edit'):
+                    github_issue.edit(state = 'closed')
+                stats.count('issues.dummy')
+                existing_issues[gid] = github_issue
+                if state_store:
+                    state_store.set_issue(gid, github_issue.number, github_issue.state)
+                    state_store.set_comments(gid, CommentIndex())
+                    state_store.commit()
             previous_gid = issue['gid']
 
         # Add the issue and its comments to Github, if we haven't already
+        rate_budget.reserve(GITHUB_ISSUE_REQUESTS + len(issue['comments']))
         if issue['gid'] in existing_issues:
             github_issue = existing_issues[issue['gid']]
             output('Not adding issue %d (exists)' % issue['gid'])
         else:
             github_issue = add_issue_to_github(issue)
+            if github_issue and state_store:
+                state_store.set_issue(issue['gid'], github_issue.number, github_issue.state)
+                state_store.set_comments(issue['gid'], CommentIndex())
+                state_store.commit()
 
         if github_issue:
             add_comments_to_issue(github_issue, issue)
             if github_issue.state != issue['state']:
-                github_issue.edit(state = issue['state'])
+                with stats.timer('github.edit'):
+                    github_issue.edit(state = issue['state'])
+            if state_store:
+                state_store.set_issue(issue['gid'], github_issue.number, github_issue.state)
+                state_store.commit()
         output('\n')
 
         log_rate_info()
 
 
-def get_existing_github_issues():
-    """ Returns a dictionary of Github issues previously migrated from Google Code.
+class ExistingIssues(object):
+    """ Github issues previously migrated from Google Code.
 
-    The result maps Google Code issue numbers to Github issue objects.
+    Maps Google Code issue numbers to LazyIssue objects. Just (number, state,
+    milestone number) of each issue is kept, along with numbers of
+    milestones by title.
     """
 
+    def __init__(self):
+        self.index = {}
+        self.milestones = {}
+
+    def __contains__(self, gid):
+        return gid in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, gid):
+        number, state, milestone_number = self.index[gid]
+        return LazyIssue(number, state)
+
+    def __setitem__(self, gid, github_issue):
+        milestone = github_issue.milestone
+        if milestone:
+            self.milestones.setdefault(milestone.title, milestone.number)
+        self.index[gid] = (github_issue.number, github_issue.state,
+                           milestone.number if milestone else None)
+
+    def items(self):
+        return self.index.items()
+
+class LazyIssue(object):
+    """ Github issue fetched on first access to anything but its number and state. """
+
+    def __init__(self, number, state):
+        self.number = number
+        self._state = state
+        self._issue = None
+
+    @property
+    def state(self):
+        return self._issue.state if self._issue else self._state
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._issue is None:
+            with stats.timer('github.get_issue'):
+                self._issue = github_repo.get_issue(self.number)
+        return getattr(self._issue, name)
+
+def iter_pages(paginated_list, timer):
+    """ Yields elements page by page, without keeping the pages around. """
+    page = 0
+    while True:
+        with stats.timer(timer):
+            elements = paginated_list.get_page(page)
+        if not elements:
+            return
+        for element in elements:
+            yield element
+        page += 1
+
+def get_existing_github_issues():
+    """ Returns ExistingIssues previously migrated from Google Code. """
+
     output("Retrieving existing Github issues...\n")
     id_re = re.compile(GOOGLE_ID_RE % google_project_name)
 
     try:
-        existing_issues = list(github_repo.get_issues(state='open')) + list(github_repo.get_issues(state='closed'))
-        existing_count = len(existing_issues)
-        issue_map = {}
-        for issue in existing_issues:
-            id_match = id_re.search(issue.body)
-            if not id_match:
-                continue
-
-            google_id = int(id_match.group(1))
-            issue_map[google_id] = issue
-            labels = [l.name for l in issue.get_labels()]
-            if not 'imported' in labels:
-                # TODO we could fix up the label here instead of just warning
-                logging.warn('Issue missing imported label %s- %r - %s', google_id, labels, issue.title)
+        existing_count = 0
+        issue_map = ExistingIssues()
+        for state in 'open', 'closed':
+            for issue in iter_pages(github_repo.get_issues(state=state), 'github.get_issues'):
+                existing_count += 1
+                id_match = id_re.search(issue.body)
+                if not id_match:
+                    continue
+
+                google_id = int(id_match.group(1))
+                issue_map[google_id] = issue
+                # labels come along with the issue, unlike get_labels()
+                labels = [l.name for l in issue.labels]
+                if not 'imported' in labels:
+                    # TODO we could fix up the label here instead of just warning
+                    logging.warn('Issue missing imported label %s- %r - %s', google_id, labels, issue.title)
         imported_count = len(issue_map)
         logging.info('Found %d Github issues, %d imported',existing_count,imported_count)
     except:
@@ -419,6 +712,152 @@ def get_existing_github_issues():
     return issue_map
 
 
+class StateStore(object):
+    """ Local record of what has been migrated, kept in an SQLite database.
+
+    For each Google Code issue it keeps the number and the state of its
+    Github copy, and digests of the comments it has, so that re-runs don't
+    need to list all Github issues and their comments again. Comments of an
+    issue are known once listed from Github, or if the issue has been
+    created by the script. Milestone numbers are kept by title.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS issues (
+            gid             INTEGER PRIMARY KEY,
+            number          INTEGER NOT NULL,
+            state           TEXT NOT NULL,
+            comments_known  INTEGER NOT NULL DEFAULT 0,
+            synced_at       REAL);
+        CREATE TABLE IF NOT EXISTS comments (
+            gid             INTEGER NOT NULL,
+            digest          TEXT NOT NULL,
+            anchor          TEXT,
+            PRIMARY KEY (gid, digest));
+        CREATE TABLE IF NOT EXISTS milestones (
+            title           TEXT PRIMARY KEY,
+            number          INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS meta (
+            key             TEXT PRIMARY KEY,
+            value);
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(self.SCHEMA)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def issues(self):
+        """ Returns (gid, number, state) of all issues. """
+        return self.db.execute('SELECT gid, number, state FROM issues').fetchall()
+
+    def set_issue(self, gid, number, state):
+        self.db.execute('INSERT OR IGNORE INTO issues (gid, number, state) VALUES (?, ?, ?)',
+                        (gid, number, state))
+        self.db.execute('UPDATE issues SET number = ?, state = ?, synced_at = ? WHERE gid = ?',
+                        (number, state, time.time(), gid))
+
+    def remove_issue(self, gid):
+        self.db.execute('DELETE FROM issues WHERE gid = ?', (gid,))
+        self.db.execute('DELETE FROM comments WHERE gid = ?', (gid,))
+
+    def comment_index(self, gid):
+        """ Returns a CommentIndex of the issue comments, or None if unknown. """
+        row = self.db.execute('SELECT comments_known FROM issues WHERE gid = ?', (gid,)).fetchone()
+        if not row or not row[0]:
+            return None
+        index = CommentIndex()
+        for digest, anchor in self.db.execute('SELECT digest, anchor FROM comments WHERE gid = ?', (gid,)):
+            index.add(digest, anchor)
+        return index
+
+    def set_comments(self, gid, index):
+        """ Replaces the issue comments by the ones in the CommentIndex.
+
+        Keys are kept for comments whose headers don't link to the original
+        ones, but which were recorded with a key when posted.
+        """
+        anchors = dict(self.db.execute('SELECT digest, anchor FROM comments WHERE gid = ?', (gid,)))
+        self.db.execute('DELETE FROM comments WHERE gid = ?', (gid,))
+        self.db.executemany('INSERT OR IGNORE INTO comments (gid, digest, anchor) VALUES (?, ?, ?)',
+                            ((gid, digest, key or anchors.get(digest))
+                             for digest, key in index.digests.items()))
+        self.db.execute('UPDATE issues SET comments_known = 1 WHERE gid = ?', (gid,))
+
+    def add_comment(self, gid, digest, anchor = None):
+        self.db.execute('INSERT OR IGNORE INTO comments (gid, digest, anchor) VALUES (?, ?, ?)',
+                        (gid, digest, anchor))
+
+    def milestones(self):
+        return dict(self.db.execute('SELECT title, number FROM milestones'))
+
+    def set_milestone(self, title, number):
+        self.db.execute('INSERT OR REPLACE INTO milestones (title, number) VALUES (?, ?)',
+                        (title, number))
+
+
+def load_existing_issues():
+    """ Returns ExistingIssues as recorded in the state store. """
+
+    existing_issues = ExistingIssues()
+    for gid, number, state in state_store.issues():
+        existing_issues.index[gid] = (number, state, None)
+    existing_issues.milestones.update(state_store.milestones())
+    logging.info('Loaded %d imported issues from the state store', len(existing_issues))
+    return existing_issues
+
+def record_existing_issues(existing_issues):
+    """ Replaces issues and milestones in the state store with ones found on Github. """
+
+    recorded = dict((gid, (number, state)) for gid, number, state in state_store.issues())
+    for gid, (number, state, milestone_number) in existing_issues.items():
+        if recorded.pop(gid, None) != (number, state):
+            stats.count('state.issues_updated')
+        state_store.set_issue(gid, number, state)
+    for gid in recorded:
+        stats.count('state.issues_removed')
+        state_store.remove_issue(gid)
+
+    for title, number in existing_issues.milestones.items():
+        state_store.set_milestone(title, number)
+
+    state_store.set_meta('scanned_at', time.time())
+    state_store.commit()
+
+def verify_comments(existing_issues):
+    """ Reconciles comments in the state store with all comments of the repository. """
+
+    output("Retrieving existing Github comments...\n")
+    gids = dict((number, gid) for gid, (number, state, milestone_number) in existing_issues.items())
+    number_re = re.compile(r'/issues/(\d+)#')
+
+    indexes = dict((gid, CommentIndex()) for gid in gids.values())
+    for comment in iter_pages(github_repo.get_issues_comments(), 'github.get_issues_comments'):
+        number_match = number_re.search(comment.html_url)
+        if number_match and int(number_match.group(1)) in gids:
+            indexes[gids[int(number_match.group(1))]].add_listed(comment.body)
+
+    for gid, index in indexes.items():
+        recorded = state_store.comment_index(gid)
+        if recorded is None or set(recorded.digests) != set(index.digests):
+            stats.count('state.comments_updated')
+        state_store.set_comments(gid, index)
+    state_store.commit()
+
+
 def log_rate_info():
     logging.info('Rate limit (remaining/total) %r', github.rate_limiting)
     # Note: this requires extended version of PyGithub from tfmorris/PyGithub repo
@@ -438,6 +877,16 @@ if __name__ == "__main__":
     parser.add_option('--start-at', dest = 'start_at', help = 'Start at the given Google Code issue number', default = None, type = int)
     parser.add_option('--end-at', dest = 'end_at', help = 'End at the given Google Code issue number', default = None, type = int)
     parser.add_option('--migrate-stars', action = 'store_true', dest = 'migrate_stars', help = 'Migrate binned star counts as labels', default = False)
+    parser.add_option('--http-cache', dest = 'http_cache', help = 'Cache Google Code pages in the given directory', default = None)
+    parser.add_option('--http-cache-max-age', dest = 'http_cache_max_age', help = 'Download again pages cached earlier than given hours ago', default = None, type = float)
+    parser.add_option('--offline', action = 'store_true', dest = 'offline', help = 'Use cached Google Code pages only', default = False)
+    parser.add_option('--refresh', action = 'store_true', dest = 'refresh', help = 'Download all Google Code pages again and update the cache', default = False)
+    parser.add_option('--retries', dest = 'retries', help = 'Number of retries of failed Google Code requests', default = 5, type = int)
+    parser.add_option('--rate-limit', dest = 'rate_limit', help = 'Maximum number of Google Code requests per second', default = None, type = float)
+    parser.add_option('--state-db', dest = 'state_db', help = 'Keep track of migrated issues and comments in the given SQLite database', default = None)
+    parser.add_option('--verify', action = 'store_true', dest = 'verify', help = 'Reconcile the state database with Github before migrating', default = False)
+    parser.add_option('--progress', dest = 'progress', help = 'Report progress every given number of seconds', default = 0, type = float)
+    parser.add_option('--stats-file', dest = 'stats_file', help = 'Save timings and counters to a JSON file', default = None)
 
     options, args = parser.parse_args()
 
@@ -451,6 +900,29 @@ if __name__ == "__main__":
 
     google_project_name, github_user_name, github_project = args
 
+    stats = instrument.Stats()
+    progress = instrument.Progress(options.progress, lambda line: output(line + '\n'))
+    comment_poster = CommentPoster()
+    rate_budget = RateBudget()
+
+    if options.verify and not options.state_db:
+        parser.error('--verify requires --state-db')
+    state_store = StateStore(options.state_db) if options.state_db else None
+
+    if options.offline and not options.http_cache:
+        parser.error('--offline requires --http-cache')
+
+    http = httpfetch.Fetcher(
+        cache = httpfetch.ResponseCache(options.http_cache) if options.http_cache else None,
+        offline = options.offline,
+        refresh = options.refresh,
+        max_age = options.http_cache_max_age * 3600 if options.http_cache_max_age is not None else None,
+        headers = {'Cookie': options.google_code_cookie} if options.google_code_cookie else None,
+        retries = options.retries,
+        rate = options.rate_limit,
+        log = logging.warning,
+        stats = stats)
+
     while True:
         github_password = getpass.getpass("Github password: ")
         try:
@@ -481,16 +953,33 @@ if __name__ == "__main__":
     github_repo = github_owner.get_repo(github_project)
 
     try:
-        existing_issues = get_existing_github_issues()
+        if state_store and state_store.get_meta('scanned_at') and not options.verify:
+            existing_issues = load_existing_issues()
+        else:
+            existing_issues = get_existing_github_issues()
+            if state_store:
+                record_existing_issues(existing_issues)
+                if options.verify:
+                    verify_comments(existing_issues)
 
-        for i in existing_issues.values():
-            if i.milestone:
-                m = i.milestone
-                milestone_number.setdefault(m.title, m.number)
-                milestone_cache.setdefault(m.title, m)
+        # Labels are listed in bulk rather than fetched one by one
+        for label in iter_pages(github_repo.get_labels(), 'github.get_labels'):
+            label_cache.setdefault(label.name, label)
+
+        # Milestone objects are fetched by number when first used
+        for title, number in existing_issues.milestones.items():
+            milestone_number.setdefault(title, number)
 
         log_rate_info()
         process_gcode_issues(existing_issues)
     except Exception:
         parser.print_help()
         raise
+    finally:
+        if state_store:
+            state_store.close()
+        output('\n')
+        for line in stats.summary():
+            output(line + '\n')
+        if options.stats_file:
+            stats.save(options.stats_file)
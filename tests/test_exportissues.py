@@ -0,0 +1,478 @@
+#!/usr/bin/env python2
+
+"""
+Tests of exportissues.py, run against a local HTTP server standing for
+Google Code, serving canned CSV and issue pages.
+
+    python2 -m unittest discover tests
+"""
+
+import BaseHTTPServer
+import codecs
+import csv
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+
+from collections import OrderedDict
+from SocketServer import ThreadingMixIn
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import exportissues
+
+NR_ISSUES = 12
+CSV_PAGE_SIZE = 4
+
+# Runs exportissues.main() fetching from the given base URL instead of
+# https://code.google.com, with CSV pages of CSV_PAGE_SIZE issues.
+EXPORT_DRIVER = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import exportissues
+for name in 'GOOGLE_ISSUES_CSV_URL', 'GOOGLE_ISSUE_PAGE_URL':
+    setattr(exportissues, name,
+            getattr(exportissues, name).replace('https://code.google.com', sys.argv[2]))
+exportissues.GOOGLE_MAX_RESULTS = {}
+sys.argv = ['exportissues.py'] + sys.argv[3:]
+exportissues.main()
+""".format(CSV_PAGE_SIZE)
+
+CONFIG_INI = """
+[google]
+project = proj
+
+[github]
+repo = org/proj
+export-date = 2015-03-12T00:00:00Z
+
+[include]
+messages-output = messages.txt
+"""
+
+GOOGLE_ISSUE_URL = '{}/p/proj/issues/detail?id={}'
+
+CSV_COLUMNS = ['ID', 'Type', 'Status', 'Owner', 'Summary', 'AllLabels', 'Opened',
+               'OpenedTimestamp', 'Closed', 'ClosedTimestamp', 'Reporter', 'Cc']
+
+USERS = ['alice', 'bob@example.com', 'car...@example.com']
+
+
+def issue_summary(number, changed=False):
+    closed = number % 3 == 0
+    return {
+        'ID':              str(number),
+        'Type':            'Defect',
+        'Status':          'Fixed' if closed else 'Started' if changed else 'New',
+        'Owner':           USERS[number % 2] if number % 4 else '---',
+        'Summary':         'Issue {} summary'.format(number),
+        'AllLabels':       'Type-Defect, Milestone-{}.0'.format(number % 3 + 1),
+        'Opened':          'x',
+        'OpenedTimestamp': str(1300000000 + number * 86400),
+        'Closed':          'y' if closed else '',
+        'ClosedTimestamp': str(1300000000 + number * 86400 + 3600) if closed else '',
+        'Reporter':        USERS[number % 3],
+        'Cc':              ', '.join(USERS[:number % 3]),
+    }
+
+def issue_page(number, changed=False):
+    html = ['<html><body>',
+            '<div class="issuedescription"><div class="issuedescription">'
+            '<span class="author"><a class="userlink" href="/u/x/">{}</a></span>'
+            '<span class="date" title="Wed Jan 05 10:11:12 2011">Jan 5</span>'
+            '<pre>Description of issue {}, see issue {} and r{}</pre></div></div>'
+            .format(USERS[number % 3], number, number + 1, number * 10),
+            '<div class="issuecomment"><span>Sign in to add a comment</span></div>']
+    for comment_nr in range(1, number % 4 + 2):
+        html.append(
+            '<div class="issuecomment"><div class="issuecommentheader">'
+            '<a name="c{0}" href="#c{0}">Comment {0}</a> by '
+            '<a class="userlink" href="/u/y/">{1}</a> '
+            '<span class="date" title="Thu Feb 03 01:02:03 2011">Feb</span></div>'
+            '<pre>Comment {0} on issue {2}</pre>'
+            '<div class="updates"><div class="box-inner">'
+            '<b>Labels:</b> Milestone-{3}.0<br></div></div></div>'
+            .format(comment_nr, USERS[(number + comment_nr) % 3], number,
+                    (number + comment_nr) % 4 + 1))
+    if changed:
+        html.append(
+            '<div class="issuecomment"><div class="issuecommentheader">'
+            '<a name="c99" href="#c99">Comment 99</a> by '
+            '<a class="userlink" href="/u/y/">alice</a> '
+            '<span class="date" title="Fri Mar 04 05:06:07 2011">Mar</span></div>'
+            '<pre>Started working on issue {}</pre>'
+            '<div class="updates"><div class="box-inner">'
+            '<b>Status:</b> Started<br></div></div></div>'.format(number))
+    html.append('</body></html>')
+    return '\n'.join(html)
+
+
+class GoogleCodeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the issues, those in server.changed as changed since created.
+    Pages of issues in server.failing fail with a server error.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+
+        if url.path == '/p/proj/issues/csv':
+            start, num = int(query['start'][0]), int(query['num'][0])
+            out = io.BytesIO()
+            writer = csv.writer(out)
+            writer.writerow(CSV_COLUMNS)
+            for number in range(start + 1, min(start + num, NR_ISSUES) + 1):
+                summary = issue_summary(number, number in self.server.changed)
+                writer.writerow([summary[column] for column in CSV_COLUMNS])
+            if start + num < NR_ISSUES:
+                writer.writerow(['This file is truncated to {} out of {} total results.'
+                                 .format(num, NR_ISSUES)])
+            return self.send(out.getvalue(), 'text/csv')
+
+        if url.path == '/p/proj/issues/detail':
+            number = int(query['id'][0])
+            if number in self.server.failing:
+                return self.send_error(500)
+            # Earlier pages take longer, so that they arrive out of order
+            time.sleep(0.01 * (NR_ISSUES - number))
+            return self.send(issue_page(number, number in self.server.changed),
+                             'text/html; charset=UTF-8')
+
+        self.send_error(404)
+
+
+class GoogleCodeServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    changed = set()
+    failing = set()
+
+
+def read_tree(path):
+    """ Returns {relative filename: contents} of all files under the path. """
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            with open(full_path, 'rb') as f:
+                files[os.path.relpath(full_path, path)] = f.read()
+    return files
+
+
+class ExportTestCase(unittest.TestCase):
+    """ Runs exports in temporary directories against a GoogleCodeServer. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = GoogleCodeServer(('127.0.0.1', 0), GoogleCodeHandler)
+        cls.base_url = 'http://127.0.0.1:{}'.format(cls.server.server_port)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.changed = set()
+        self.server.failing = set()
+        self.work_dir = tempfile.mkdtemp(prefix='test-exportissues-')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def make_export_dir(self):
+        export_dir = tempfile.mkdtemp(dir=self.work_dir)
+        with open(os.path.join(export_dir, 'config.ini'), 'w') as f:
+            f.write(CONFIG_INI)
+        return export_dir
+
+    def export(self, *args):
+        """ Returns (output lines, out/ files, messages) of a new export. """
+        return self.export_in(self.make_export_dir(), *args)
+
+    def run_export(self, export_dir, *args):
+        """ Returns (exit status, output) of an export. """
+        env = dict((name, value) for name, value in os.environ.items()
+                   if not name.lower().endswith('_proxy'))
+        process = subprocess.Popen(
+                [sys.executable, '-c', EXPORT_DRIVER, REPO_DIR, self.base_url,
+                 '-v'] + list(args),
+                cwd=export_dir, env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        log = process.communicate()[0]
+        return process.returncode, log
+
+    def export_in(self, export_dir, *args):
+        """ Returns (output lines, out/ files, messages) of an export. """
+        status, log = self.run_export(export_dir, *args)
+        self.assertEqual(status, 0, log)
+
+        with open(os.path.join(export_dir, 'messages.txt'), 'rb') as f:
+            messages = f.read()
+        return (log.splitlines(), read_tree(os.path.join(export_dir, 'out')),
+                messages)
+
+    def exported_numbers(self, log):
+        return [int(line.split()[-1]) for line in log
+                if line.startswith('Exporting issue ')]
+
+    def assertSameExport(self, export, expected):
+        log, files, messages = export
+        expected_log, expected_files, expected_messages = expected
+        self.assertEqual(sorted(files), sorted(expected_files))
+        for filename in sorted(files):
+            self.assertEqual(files[filename], expected_files[filename], filename)
+        self.assertEqual(messages, expected_messages)
+
+
+class PrefetchTest(ExportTestCase):
+
+    def test_fetch_workers(self):
+        log, files, messages = self.export('--fetch-workers', '1')
+
+        self.assertEqual(self.exported_numbers(log), range(1, NR_ISSUES + 1))
+        for number in range(1, NR_ISSUES + 1):
+            self.assertIn(os.path.join('issues', '{}.json'.format(number)), files)
+            self.assertIn(os.path.join('issues', '{}.comments.json'.format(number)), files)
+        self.assertIn(os.path.join('milestones', '1.json'), files)
+
+        for workers in 2, 8:
+            export = self.export('--fetch-workers', str(workers))
+            self.assertEqual(self.exported_numbers(export[0]),
+                             self.exported_numbers(log))
+            self.assertSameExport(export, (log, files, messages))
+
+    def test_parse_workers(self):
+        expected = self.export()
+        export = self.export('--fetch-workers', '4', '--parse-workers', '2')
+        self.assertEqual(self.exported_numbers(export[0]), range(1, NR_ISSUES + 1))
+        self.assertSameExport(export, expected)
+
+
+class IncrementalTest(ExportTestCase):
+
+    def test_incremental(self):
+        export_dir = self.make_export_dir()
+        args = ('--incremental', '--http-cache', '.http-cache')
+        first = self.export_in(export_dir, *args)
+        self.assertEqual(self.exported_numbers(first[0]), range(1, NR_ISSUES + 1))
+
+        again = self.export_in(export_dir, *args)
+        self.assertEqual(self.exported_numbers(again[0]), [])
+        self.assertSameExport(again, first)
+
+        # Changed issues are exported again, not from stale cached pages
+        self.server.changed = set([5, 10])
+        changed = self.export_in(export_dir, *args)
+        self.assertEqual(self.exported_numbers(changed[0]), [5, 10])
+        self.assertSameExport(changed, self.export())
+        self.assertNotEqual(changed[1], first[1])
+
+
+
+class ShardsTest(ExportTestCase):
+
+    def test_shards(self):
+        log, files, messages = self.export()
+        shards_log, shards, shards_messages = self.export('--shard-size', '5')
+
+        self.assertEqual(shards_messages, messages)
+        self.assertEqual(sorted(name for name in shards if not name.startswith('issues')),
+                         sorted(name for name in files if not name.startswith('issues')))
+        for filename in shards:
+            if not filename.startswith('issues'):
+                self.assertEqual(shards[filename], files[filename], filename)
+
+        self.assertEqual(sorted(shards), sorted(
+                [os.path.join('issues', name)
+                 for name in 'index.json', '1-5.ndjson', '6-10.ndjson', '11-15.ndjson']
+                + [name for name in files if not name.startswith('issues')]))
+
+        # Each indexed line has the contents of both files of its issue,
+        # and the lines of each shard follow each other in order
+        index = json.loads(shards[os.path.join('issues', 'index.json')])
+        self.assertEqual(sorted(map(int, index)), range(1, NR_ISSUES + 1))
+        lines = {}
+        for number in range(1, NR_ISSUES + 1):
+            shard, offset, length = index[str(number)]
+            line = shards[os.path.join('issues', shard)][offset:offset + length]
+            self.assertTrue(line.endswith('\n'))
+            self.assertEqual(json.loads(line), {
+                'issue':    json.loads(files[os.path.join('issues', '{}.json'.format(number))]),
+                'comments': json.loads(files[os.path.join('issues', '{}.comments.json'
+                                                          .format(number))]),
+            })
+            lines.setdefault(shard, []).append(line)
+        for shard, shard_lines in lines.items():
+            self.assertEqual(shards[os.path.join('issues', shard)], ''.join(shard_lines))
+
+    def test_incremental_shards(self):
+        export_dir = self.make_export_dir()
+        args = ('--shard-size', '5', '--incremental')
+        first = self.export_in(export_dir, *args)
+
+        again = self.export_in(export_dir, *args)
+        self.assertEqual(self.exported_numbers(again[0]), [])
+        self.assertSameExport(again, first)
+
+        self.server.changed = set([5, 10])
+        changed = self.export_in(export_dir, *args)
+        self.assertEqual(self.exported_numbers(changed[0]), [5, 10])
+        self.assertSameExport(changed, self.export('--shard-size', '5'))
+
+
+def read_messages_loading(filename):
+    """ Reads the messages file the way it was read before being indexed. """
+    messages = OrderedDict()
+
+    msg_id = None
+    with codecs.open(filename, "r", encoding='utf-8') as f:
+        for line in f:
+            frags = line.split(None, 4)
+            if len(frags) == 4:
+                start, mb_msg_id, checksum, end = frags
+                if (start == '<!--' and end == '-->' and
+                    checksum == hashlib.md5(mb_msg_id).hexdigest()):
+                    msg_id = mb_msg_id
+                    continue
+
+            messages[msg_id] = messages.get(msg_id, '') + line
+        else:
+            messages.setdefault(msg_id, '')
+    messages.pop(None, None)
+
+    for msg_id, body in messages.items():
+        messages[msg_id] = body.strip()
+    return messages
+
+
+class MessagesTest(ExportTestCase):
+
+    def marker(self, msg_id):
+        return '<!--  {}   {}  -->\n'.format(msg_id, hashlib.md5(msg_id).hexdigest())
+
+    def test_index(self):
+        filename = os.path.join(self.work_dir, 'messages.txt')
+        with open(filename, 'wb') as f:
+            f.write('Text before the first message\n' +
+                    self.marker('a#c1') + 'First\n\n  Caf\xc3\xa9  \n\n' +
+                    '<!--  b#c1   0123456789abcdef0123456789abcdef  -->\n' +
+                    'one two three four\n' +
+                    self.marker('e#c1') +
+                    self.marker('b#c1') + 'Second\n' +
+                    self.marker('c#c1') +
+                    self.marker('a#c1') + 'continued\n\n' +
+                    self.marker('e#c1') + 'Then\n' +
+                    self.marker('d#c1') + 'Last')
+
+        store = exportissues.MessageStore(filename)
+        try:
+            self.assertEqual(list(store.items()),
+                             read_messages_loading(filename).items())
+            self.assertNotIn('c#c1', store)
+        finally:
+            store.close()
+
+    def test_overrides(self):
+        log, files, messages = self.export()
+
+        # Override two messages, one of them in two parts
+        description = GOOGLE_ISSUE_URL.format(self.base_url, 2)
+        comment = GOOGLE_ISSUE_URL.format(self.base_url, 4) + '#c1'
+        overrides = (self.marker(description) + 'Edited description \xc3\xa9\n\n' +
+                     self.marker(comment) + 'Edited\n' +
+                     self.marker(description) + 'in two parts\n')
+        export_dir = self.make_export_dir()
+        with open(os.path.join(export_dir, 'overrides.txt'), 'wb') as f:
+            f.write(overrides)
+        edited_log, edited, edited_messages = self.export_in(
+                export_dir, '--messages-input', 'overrides.txt')
+
+        issue = json.loads(edited[os.path.join('issues', '2.json')])
+        self.assertIn(u'\n\nEdited description \xe9\n\nin two parts\n', issue['body'])
+        comments = json.loads(edited[os.path.join('issues', '4.comments.json')])
+        self.assertIn(u'\n\nEdited\n', comments[0]['body'])
+
+        for filename in files:
+            if filename not in (os.path.join('issues', '2.json'),
+                                os.path.join('issues', '4.comments.json')):
+                self.assertEqual(edited[filename], files[filename], filename)
+        self.assertTrue(edited_messages.startswith(
+                self.marker(description) + 'Edited description \xc3\xa9\n\nin two parts\n\n' +
+                self.marker(comment) + 'Edited\n\n'))
+
+
+class TmpFilesTest(ExportTestCase):
+
+    def test_stale_tmp_files(self):
+        export_dir = self.make_export_dir()
+        args = ('--http-cache', '.http-cache')
+        expected = self.export_in(export_dir, *args)
+
+        # as left by a killed run
+        stale = [os.path.join('out', 'issues', '3.json.tmp'),
+                 os.path.join('.http-cache', 'objects', 'ab', 'cdef.gz.1234.tmp'),
+                 os.path.join('.attachments', 'ab', 'abcdef.1234.tmp')]
+        for filename in stale:
+            filename = os.path.join(export_dir, filename)
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'wb') as f:
+                f.write('partial')
+
+        self.assertSameExport(self.export_in(export_dir, *args), expected)
+        for dirpath, dirnames, filenames in os.walk(export_dir):
+            self.assertEqual([name for name in filenames if name.endswith('.tmp')], [],
+                             dirpath)
+
+
+class ResumeTest(ExportTestCase):
+
+    def test_resume(self):
+        export_dir = self.make_export_dir()
+        args = ('--retries', '0', '--checkpoint-every', '2')
+        self.server.failing = set([7])
+        status, log = self.run_export(export_dir, *args)
+        self.assertNotEqual(status, 0, log)
+        self.assertTrue(os.path.exists(os.path.join(export_dir, '.export-checkpoint.json')))
+
+        # The export date of the checkpoint can't be changed
+        status, log = self.run_export(export_dir, '--resume',
+                                      '--export-date', '2015-03-13T00:00:00Z', *args)
+        self.assertNotEqual(status, 0, log)
+        self.assertIn('saved with export date 2015-03-12T00:00:00Z', log)
+
+        self.server.failing = set()
+        resumed = self.export_in(export_dir, '--resume', *args)
+        self.assertEqual(self.exported_numbers(resumed[0]), range(7, NR_ISSUES + 1))
+        self.assertSameExport(resumed, self.export())
+        self.assertFalse(os.path.exists(os.path.join(export_dir, '.export-checkpoint.json')))
+
+
+if __name__ == '__main__':
+    unittest.main()
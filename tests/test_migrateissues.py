@@ -0,0 +1,216 @@
+#!/usr/bin/env python2
+
+"""
+Tests of migrateissues.py, run against a fake clock and fake Github objects.
+
+    python2 -m unittest discover tests
+"""
+
+import datetime
+import math
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import instrument
+import migrateissues
+
+
+class FakeClock(object):
+    """ Stands for the time module, sleeping only advances the time. """
+
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeRateLimit(object):
+    """ Github rate limit of requests, reset every hour of the fake clock. """
+
+    def __init__(self, clock, limit, remaining):
+        self.clock = clock
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = clock.now + 3600
+        self.nr_asked = 0
+
+    @property
+    def rate_limiting(self):
+        return self.remaining, self.limit
+
+    def request(self, count=1):
+        if self.clock.now >= self.reset:
+            self.reset += 3600
+            self.remaining = self.limit
+        assert self.remaining >= count, 'rate limit exceeded'
+        self.remaining -= count
+
+    def get(self):
+        self.request(0)
+        self.nr_asked += 1
+        return self.remaining, self.limit, self.reset
+
+
+class MigrateTestCase(unittest.TestCase):
+    """ Replaces the clock and the global state of migrateissues. """
+
+    def setUp(self):
+        self.saved = dict((name, getattr(migrateissues, name, None))
+                          for name in ('time', 'stats', 'output', 'github', 'get_rate_limit'))
+        self.clock = FakeClock(1400000000.0)
+        self.log = []
+        migrateissues.time = self.clock
+        migrateissues.stats = instrument.Stats()
+        migrateissues.output = self.log.append
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(migrateissues, name, value)
+
+    def use_rate_limit(self, limit, remaining):
+        self.rate = FakeRateLimit(self.clock, limit, remaining)
+        migrateissues.github = self.rate
+        migrateissues.get_rate_limit = self.rate.get
+
+
+class RateBudgetTest(MigrateTestCase):
+
+    spare = migrateissues.GITHUB_SPARE_REQUESTS
+
+    def test_spreads_requests(self):
+        self.use_rate_limit(5000, 1000 + self.spare)
+        budget = migrateissues.RateBudget()
+
+        budget.reserve(4)
+        self.assertEqual(self.clock.sleeps, [])
+        self.rate.request(4)
+
+        # The 4 requests made take their share of the rest of the window
+        start = self.clock.now
+        budget.reserve(4)
+        self.assertEqual(len(self.clock.sleeps), 1)
+        self.assertAlmostEqual(self.clock.sleeps[0], 4 * 3600.0 / 996, places=3)
+        self.assertEqual(self.clock.now, start + self.clock.sleeps[0])
+        self.assertEqual(self.rate.nr_asked, 1)
+
+    def test_fewer_requests_than_reserved(self):
+        self.use_rate_limit(5000, 1000 + self.spare)
+        budget = migrateissues.RateBudget()
+
+        budget.reserve(4)
+        budget.reserve(4)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_waits_for_reset(self):
+        self.use_rate_limit(5000, 3 + self.spare)
+        budget = migrateissues.RateBudget()
+        reset = self.rate.reset
+
+        budget.reserve(4)
+        self.assertEqual(self.clock.sleeps, [reset - 1400000000.0 + 1])
+        self.assertEqual(self.rate.remaining, 5000)
+        self.assertEqual(len(self.log), 1)
+        self.assertEqual(budget.remaining, 5000)
+
+    def test_paces_over_the_window(self):
+        self.use_rate_limit(5000, 1000 + self.spare)
+        budget = migrateissues.RateBudget()
+        reset = self.rate.reset
+
+        # Spread evenly, the requests of the window last until it resets,
+        # so that the next ones don't need to wait for the reset
+        for i in range(300):
+            budget.reserve(4)
+            self.rate.request(4)
+            if i == 248:
+                self.assertLess(self.clock.now, reset)
+                self.assertGreater(self.clock.now, reset - 60)
+        self.assertEqual(self.rate.reset, reset + 3600)
+        self.assertEqual(self.log, [])
+
+    def test_more_requests_than_a_window(self):
+        self.use_rate_limit(100, 100)
+        budget = migrateissues.RateBudget()
+
+        budget.reserve(500)
+        self.assertEqual(self.clock.sleeps, [])
+
+
+class FakeComment(object):
+
+    def __init__(self, created_at):
+        self.created_at = created_at
+
+
+class FakeIssue(object):
+    """
+    Github issue creating comments at a random point of each round trip,
+    on the Github clock, offset from the fake one.
+    """
+
+    def __init__(self, clock, number, offset, round_trip, created):
+        self.clock = clock
+        self.number = number
+        self.offset = offset
+        self.round_trip = round_trip
+        self.created = created  # Github time of each comment created
+        self.random = random.Random(number)
+
+    def create_comment(self, body):
+        created = self.clock.now + self.offset + self.random.uniform(0, self.round_trip)
+        self.clock.now += self.round_trip
+        self.created.append(created)
+        return FakeComment(datetime.datetime.utcfromtimestamp(math.floor(created)))
+
+
+class CommentPosterTest(MigrateTestCase):
+
+    def post(self, nr_comments, offset, round_trip, between=0):
+        """ Returns Github times of comments posted to a single issue. """
+        created = []
+        issue = FakeIssue(self.clock, 1, offset, round_trip, created)
+        poster = migrateissues.CommentPoster()
+        for i in range(nr_comments):
+            poster.post(issue, 'comment')
+            self.clock.now += between
+        return created
+
+    def test_order(self):
+        for offset in 0.3, -0.7, 12.45, -3600.2:
+            for round_trip in 0.02, 0.3, 0.9, 1.5:
+                seconds = [math.floor(created) for created in self.post(30, offset, round_trip)]
+                for previous, second in zip(seconds, seconds[1:]):
+                    self.assertGreater(second, previous, (offset, round_trip))
+
+    def test_wait_bounds(self):
+        start = self.clock.now
+        self.post(30, 2.6, 0.02)
+
+        # never longer than a second, and about one comment per second
+        self.assertLessEqual(max(self.clock.sleeps), 1)
+        self.assertLess((self.clock.now - start) / 30, 1.05)
+
+    def test_no_wait_a_second_after_response(self):
+        self.post(10, 2.6, 0.02, between=1)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_no_wait_between_issues(self):
+        created = []
+        poster = migrateissues.CommentPoster()
+        for number in range(1, 10):
+            poster.post(FakeIssue(self.clock, number, 0.5, 0.02, created), 'comment')
+        self.assertEqual(self.clock.sleeps, [])
+
+
+if __name__ == '__main__':
+    unittest.main()